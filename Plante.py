@@ -1,10 +1,34 @@
+import time
+START_TIME = time.perf_counter()
+
+import importlib
+import logging
+import sys
 import tkinter as tk
 from tkinter import ttk
-from ui_functions import setup_ui
+from ui_functions import setup_ui, preload_modules, HEAVY_MODULES
+
+def window_shown(root, measure_only):
+    # Runs once the event loop is idle, i.e. after the window has been drawn
+    root.update_idletasks()
+    elapsed = time.perf_counter() - START_TIME
+    logging.info('Window shown %.3f s after start', elapsed)
+
+    if not measure_only:
+        preload_modules()
+        return
+
+    # Startup time measurement (--startup-time): report, load the image stack and quit
+    print(f'Window shown after {elapsed:.3f} s')
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+    print(f'Image processing ready after {time.perf_counter() - START_TIME:.3f} s')
+    root.destroy()
 
 def main():
     root = tk.Tk()
     setup_ui(root)
+    root.after_idle(window_shown, root, '--startup-time' in sys.argv)
     root.mainloop()
 
 if __name__ == "__main__":
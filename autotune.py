@@ -0,0 +1,301 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from batch import add_processing_arguments, build_trays, calibrator_from_args, params_from_args
+from config import choose_label
+
+# Histogram bin widths for H, S and V. Thresholds are searched on bin edges.
+BIN_WIDTHS = np.array([2, 4, 4])
+NUM_BINS = np.array([90, 64, 64])
+
+DEFAULT_KERNEL_SIZES = (20, 30, 40, 50, 60, 80, 100)
+
+
+def load_reference(csv_path):
+    """
+    Read the known leaf areas from a CSV in the batch.py output format.
+
+    Image names are resolved relative to the CSV file, rows without an area
+    (failed images, empty cells) are skipped.
+
+    Returns:
+    dict: Image path to {label: area in cm²}.
+    """
+    directory = os.path.dirname(os.path.abspath(csv_path))
+    reference = {}
+    with open(csv_path, newline='') as file:
+        for row in csv.DictReader(file):
+            if row.get('error') or not row.get('area_cm2'):
+                continue
+            path = os.path.join(directory, row['image'])
+            reference.setdefault(path, {})[row['label']] = float(row['area_cm2'])
+    return reference
+
+
+def prepare_reference(image_path, areas, conversion_factor, label_mapping, params):
+    """
+    Decode a reference image once and precompute everything the trials share.
+
+    The image is split into plants with the current parameters. The HSV
+    histogram of all the pixels of every reference plant's dilated region is
+    turned into a 3-D cumulative sum, so the green area that any threshold
+    box gives the plant (as long as the regions stay the same) is 8 lookups.
+
+    Returns:
+    dict: The decoded 'image' and its 'hsv' conversion, its 'conversion_factor', reference 'areas' in
+        pixels by label, the reference 'labels' found in the image and their
+        'cumulative' histograms ((P, H+1, S+1, V+1)).
+    """
+    import image_processing
+
+    image = image_processing.load_image(image_path)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    trays = build_trays(params['trays'])
+
+    mask = cv2.inRange(hsv, params['lower_green'], params['upper_green'])
+    dilated_mask = image_processing.dilate(mask, params['dilation_kernel_size'])
+    stats = image_processing.component_stats(image, mask, dilated_mask)
+    regions = image_processing.select_regions(stats, conversion_factor, label_mapping, params['min_area'],
+                                              params['max_regions'], params['num_columns'], trays)
+    regions = [region for region in regions if region['label'] in areas]
+    labels = [region['label'] for region in regions]
+
+    # Label i + 1 of the label image is region i of stats
+    plant_of_component = np.full(len(stats['area']) + 1, -1)
+    for idx, region in enumerate(regions):
+        plant_of_component[region['component'] + 1] = idx
+
+    # One histogram per plant: index every pixel by (plant, h bin, s bin, v bin)
+    plants = plant_of_component[stats['labels'].ravel()]
+    inside = np.flatnonzero(plants >= 0)
+    bins = hsv.reshape(-1, 3)[inside] // BIN_WIDTHS
+    index = np.ravel_multi_index((plants[inside], bins[:, 0], bins[:, 1], bins[:, 2]), (len(labels), *NUM_BINS))
+    histograms = np.bincount(index, minlength=len(labels) * NUM_BINS.prod()).reshape(len(labels), *NUM_BINS)
+
+    # int32 halves the size (about 35 MB for 24 plants), no plant has 2**31 pixels
+    cumulative = np.zeros((len(labels), *(NUM_BINS + 1)), dtype=np.int32)
+    cumulative[:, 1:, 1:, 1:] = histograms.cumsum(1).cumsum(2).cumsum(3)
+
+    return {
+        'path': image_path,
+        'image': image,
+        'hsv': hsv,
+        'conversion_factor': conversion_factor,
+        'areas': {label: area / conversion_factor ** 2 for label, area in areas.items()},
+        'labels': labels,
+        'cumulative': cumulative,
+    }
+
+
+def candidate_boxes(hue_lower=range(5, 36), hue_upper=range(30, 61), saturation_lower=range(0, 42, 2),
+                    value_lower=range(0, 42, 2)):
+    """
+    Threshold boxes to search, in histogram bins (see box_thresholds).
+
+    Upper saturation and value bounds stay at 255, dark or washed out leaves
+    are excluded by the lower bounds. The defaults cover hues 10 to 121 and
+    lower saturations and values up to 167, every other bin; refine_boxes
+    fills in around the best ones.
+
+    Returns:
+    numpy.ndarray: (N, 6) lower H, S, V bins and upper (exclusive) H, S, V bins.
+    """
+    boxes = [(h0, s0, v0, h1, NUM_BINS[1], NUM_BINS[2])
+             for h0, h1, s0, v0 in itertools.product(hue_lower, hue_upper, saturation_lower, value_lower) if h1 > h0]
+    return np.array(boxes, dtype=np.intp)
+
+
+def refine_boxes(boxes):
+    """All the boxes one bin away from the given ones in any of the searched bounds (them included)."""
+    offsets = np.zeros((81, 6), dtype=np.intp)
+    offsets[:, [0, 1, 2, 3]] = list(itertools.product((-1, 0, 1), repeat=4))
+    refined = (boxes[:, None, :] + offsets[None, :, :]).reshape(-1, 6)
+    refined[:, :3] = np.clip(refined[:, :3], 0, NUM_BINS - 1)
+    refined[:, 3] = np.clip(refined[:, 3], 1, NUM_BINS[0])
+    refined = refined[refined[:, 3] > refined[:, 0]]
+    return np.unique(refined, axis=0)
+
+
+def best_distinct(boxes, scores, count):
+    """The count best boxes, keeping one box per score (boxes with equal scores select the same pixels)."""
+    _, first = np.unique(scores, return_index=True)
+    return boxes[first[:count]], scores[first[:count]]
+
+
+def box_thresholds(box):
+    """The inRange lower and upper bounds of a box in histogram bins."""
+    lower = tuple(int(v) for v in box[:3] * BIN_WIDTHS)
+    upper = tuple(int(v) for v in np.minimum(box[3:] * BIN_WIDTHS - 1, 255))
+    return lower, upper
+
+
+def box_counts(cumulative, boxes):
+    """
+    Count the pixels of every plant inside every box by inclusion-exclusion.
+
+    Returns:
+    numpy.ndarray: (N boxes, P plants) pixel counts.
+    """
+    h0, s0, v0, h1, s1, v1 = boxes.T
+    c = cumulative
+    counts = (c[:, h1, s1, v1] - c[:, h0, s1, v1] - c[:, h1, s0, v1] - c[:, h1, s1, v0]
+              + c[:, h0, s0, v1] + c[:, h0, s1, v0] + c[:, h1, s0, v0] - c[:, h0, s0, v0])
+    return counts.T
+
+
+def score_boxes(references, boxes, chunk_size=20000):
+    """
+    Mean relative area error of every box over all reference plants, from the histograms only.
+
+    Returns:
+    numpy.ndarray: One score per box, lower is better.
+    """
+    scores = np.zeros(len(boxes))
+    num_plants = sum(len(reference['labels']) for reference in references)
+    for start in range(0, len(boxes), chunk_size):
+        chunk = boxes[start:start + chunk_size]
+        for reference in references:
+            truth = np.array([reference['areas'][label] for label in reference['labels']])
+            counts = box_counts(reference['cumulative'], chunk)
+            scores[start:start + chunk_size] += (np.abs(counts - truth) / truth).sum(axis=1)
+    return scores / max(num_plants, 1)
+
+
+def evaluate(reference, lower_green, upper_green, kernel_sizes, conversion_factor, label_mapping, params):
+    """
+    Run the rest of the pipeline on a cached HSV image for one threshold box and every kernel size.
+
+    Reference plants that are not found count as a 100% error.
+
+    Returns:
+    list: Sum of the relative area errors for every kernel size.
+    """
+    import image_processing
+
+    trays = build_trays(params['trays'])
+    mask = cv2.inRange(reference['hsv'], lower_green, upper_green)
+    errors = []
+    for kernel_size in kernel_sizes:
+        dilated_mask = image_processing.dilate(mask, (kernel_size, kernel_size))
+        stats = image_processing.component_stats(reference['image'], mask, dilated_mask)
+        regions = image_processing.select_regions(stats, conversion_factor, label_mapping, params['min_area'],
+                                                  params['max_regions'], params['num_columns'], trays)
+        found = {region['label']: region['pixel_area'] for region in regions}
+        errors.append(sum(abs(found.get(label, 0) - area) / area for label, area in reference['areas'].items()))
+    return errors
+
+
+def autotune(reference, conversion_factor, label_preset, params, kernel_sizes=DEFAULT_KERNEL_SIZES, top=20,
+             workers=None):
+    """
+    Search the thresholds and dilation kernel size that best reproduce known leaf areas.
+
+    Every reference image is decoded and converted to HSV once. All
+    candidate threshold boxes are first scored from per-plant HSV histograms,
+    then the top ones are run through dilation, component labeling and the
+    grid fit for every kernel size, on a thread pool (OpenCV releases the
+    GIL) sharing the cached HSV images.
+
+    Args:
+    reference (dict): Known areas, see load_reference.
+    conversion_factor (float or dict): Factor to convert pixel to real-world units, or image path to factor.
+    label_preset (int): Label preset passed to choose_label.
+    params (dict): Segmentation parameters, see batch.params_from_args.
+    kernel_sizes (list): Dilation kernel sizes to try.
+    top (int): Number of threshold boxes kept for the full evaluation.
+    workers (int): Number of threads, defaults to the CPU count.
+
+    Returns:
+    list: Trial dicts ('lower_green', 'upper_green', 'dilation_kernel_size', 'error'), best first.
+    """
+    label_mapping = choose_label(label_preset)
+    factors = conversion_factor if isinstance(conversion_factor, dict) else dict.fromkeys(reference, conversion_factor)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        references = list(executor.map(
+            lambda item: prepare_reference(item[0], item[1], factors[item[0]], label_mapping, params),
+            reference.items()))
+        num_plants = sum(len(ref['areas']) for ref in references)
+        for ref in references:
+            missing = len(ref['areas']) - len(ref['labels'])
+            if missing:
+                print(f"{os.path.basename(ref['path'])}: {missing} reference plants not found with the "
+                      f"starting parameters", file=sys.stderr)
+
+        # Coarse search, then every bin around the best boxes
+        boxes = candidate_boxes()
+        best_boxes, _ = best_distinct(boxes, score_boxes(references, boxes), 2 * top)
+        refined = refine_boxes(best_boxes)
+        best_boxes, _ = best_distinct(refined, score_boxes(references, refined), top)
+        print(f'Scored {len(boxes) + len(refined)} threshold boxes, evaluating the best {len(best_boxes)} with '
+              f'{len(kernel_sizes)} kernel sizes', file=sys.stderr)
+
+        trials = [(box_thresholds(box), ref) for box in best_boxes for ref in references]
+        results = executor.map(lambda trial: evaluate(trial[1], *trial[0], kernel_sizes,
+                                                      trial[1]['conversion_factor'], label_mapping, params), trials)
+        totals = {}
+        for ((lower, upper), _), errors in zip(trials, results):
+            for kernel_size, error in zip(kernel_sizes, errors):
+                totals[lower, upper, kernel_size] = totals.get((lower, upper, kernel_size), 0.0) + error
+
+    ranked = sorted(totals.items(), key=lambda item: item[1])
+    return [{'lower_green': lower, 'upper_green': upper, 'dilation_kernel_size': kernel_size,
+             'error': error / max(num_plants, 1)} for (lower, upper, kernel_size), error in ranked]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find the segmentation parameters that best reproduce known leaf areas.')
+    parser.add_argument('reference', help='CSV with the known areas, in the batch.py output format '
+                                          '(image, label, area_cm2); images are relative to it.')
+    parser.add_argument('--kernel-sizes', type=int, nargs='+', default=DEFAULT_KERNEL_SIZES,
+                        help='Dilation kernel sizes to try.')
+    parser.add_argument('--top', type=int, default=20,
+                        help='Number of threshold boxes from the histogram search that are fully evaluated.')
+    parser.add_argument('-o', '--output', default=None, help='Write every evaluated trial to this JSON file.')
+    add_processing_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    reference = load_reference(args.reference)
+    if not reference:
+        print('No reference areas found.', file=sys.stderr)
+        return 1
+
+    conversion_factor = args.conversion_factor
+    calibrator = calibrator_from_args(args)
+    if calibrator:
+        # Few reference images, calibrate them here rather than in the trials
+        conversion_factor = {path: calibrator.conversion_factor(path) for path in reference}
+        missing = [os.path.basename(path) for path, factor in conversion_factor.items() if factor is None]
+        if missing:
+            print(f"No reference marker found in {', '.join(missing)}", file=sys.stderr)
+            return 1
+
+    trials = autotune(reference, conversion_factor, args.preset, params_from_args(args), args.kernel_sizes,
+                      args.top, args.workers)
+
+    for trial in trials[:5]:
+        print(f"mean error {trial['error']:6.2%}  lower {trial['lower_green']}  upper {trial['upper_green']}  "
+              f"kernel {trial['dilation_kernel_size']}", file=sys.stderr)
+    best = trials[0]
+    print('--lower-green {} {} {} --upper-green {} {} {} --dilation-kernel-size {}'.format(
+        *best['lower_green'], *best['upper_green'], best['dilation_kernel_size']))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'trials': trials}, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
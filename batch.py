@@ -0,0 +1,333 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import CALIBRATION_FILE, choose_label
+from export import FORMATS, RecordWriter, region_records
+
+# File extensions picked up when a directory is given as input
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+# Pipeline buffers of this worker process, reused by every image it processes
+_workspace = None
+# Result cache of this worker process, it keeps a running total of the cache size between images
+_cache = None
+
+
+def collect_images(inputs):
+    """
+    Expand directories and glob patterns into a sorted list of image paths.
+
+    Args:
+    inputs (list): Directories, glob patterns or file paths.
+
+    Returns:
+    list: Unique image paths in a stable (sorted) order.
+    """
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for name in os.listdir(item):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.add(os.path.join(item, name))
+        else:
+            paths.update(p for p in glob.glob(item) if os.path.isfile(p))
+    return sorted(paths)
+
+
+def worker_workspace():
+    """Return the Workspace of the current process, created on first use."""
+    global _workspace
+    if _workspace is None:
+        from workspace import Workspace
+
+        _workspace = Workspace()
+    return _workspace
+
+
+def worker_cache(cache_dir):
+    """Return the ResultCache of the current process for cache_dir, None when caching is disabled."""
+    global _cache
+    if cache_dir is None:
+        return None
+    if _cache is None or _cache.directory != cache_dir:
+        from cache import ResultCache
+
+        _cache = ResultCache(cache_dir)
+    return _cache
+
+
+def process_one(image_path, conversion_factor, label_preset, params, render_dir=None, cache_dir=None, profile=False):
+    """
+    Process a single image inside a worker process.
+
+    Only the measurement stage runs unless render_dir is given, in which case
+    the verification grid and annotated image are saved there as PNG.
+    Measurement-only runs go through the cache_dir result cache.
+
+    Args:
+    image_path (str): Path to the image.
+    conversion_factor (float): Factor to convert pixel to real-world units, None to measure the reference marker
+        of this image (params['marker_size']).
+    label_preset (int): Label preset passed to choose_label.
+    params (dict): Segmentation parameters, see params_from_args.
+    render_dir (str): Directory for rendered images, None to skip rendering.
+    cache_dir (str): Result cache directory, None to disable caching.
+    profile (bool): Collect per-stage timings and allocations.
+
+    Returns:
+    tuple: Image path, list of export records (see export.region_records,
+        empty cells last without an area), an error message (None on
+        success) and the profiling report as a dict (None unless profiling).
+    """
+    import image_processing
+    from calibration import per_image_factor
+    from profiling import StageReport, NULL_REPORT
+
+    report = StageReport() if profile else NULL_REPORT
+    workspace = worker_workspace()
+    try:
+        label_mapping = choose_label(label_preset)
+        trays = build_trays(params['trays'])
+        # Shared by the marker measurement and the pipeline, the image is decoded once
+        source = image_processing.ImageSource(image_path)
+        if conversion_factor is None:
+            with report.stage('calibration'):
+                conversion_factor = per_image_factor(source, params['marker_size'])
+
+        if render_dir:
+            stem = os.path.splitext(os.path.basename(image_path))[0]
+            with report.stage('decode'):
+                image = image_processing.load_image(source)
+                report.record('image', image)
+            mask, dilated_mask = image_processing.segment_image(
+                image, params['lower_green'], params['upper_green'], params['dilation_kernel_size'], report, workspace)
+            regions = image_processing.measure_regions(
+                image, mask, dilated_mask, conversion_factor, label_mapping, params['min_area'], params['max_regions'],
+                params['num_columns'], trays, report, workspace)
+
+            isolated_green = image_processing.isolate_green(image, mask, report, workspace)
+            image_processing.render_region_grid(isolated_green, regions, params['grid_size'], params['num_columns'],
+                                                report).save(os.path.join(render_dir, f'{stem}_grid.png'))
+            image_processing.render_annotated_image(isolated_green, regions, report, workspace) \
+                .save(os.path.join(render_dir, f'{stem}_annotated.png'))
+        else:
+            regions = image_processing.measure_image(
+                source, conversion_factor, label_mapping, params['lower_green'], params['upper_green'],
+                params['min_area'], params['dilation_kernel_size'], params['max_regions'], params['num_columns'], trays,
+                cache=worker_cache(cache_dir), tile_height=params['tile_height'], report=report,
+                workspace=workspace)
+    except Exception as e:
+        return image_path, [], f'{type(e).__name__}: {str(e).strip()}', None
+
+    profile_data = report.to_dict() if profile else None
+    empty = image_processing.find_empty_cells(regions, label_mapping, params['num_columns'], trays)
+    records = list(region_records(os.path.basename(image_path), regions, conversion_factor, params, empty))
+    return image_path, records, None, profile_data
+
+
+def build_trays(tray_specs):
+    """
+    Build the tray dicts of select_regions from (name, preset, num_columns) specs.
+
+    Returns:
+    list: Tray dicts, None for a single tray.
+    """
+    if not tray_specs:
+        return None
+    return [{'name': name, 'label_mapping': choose_label(preset), 'num_columns': num_columns}
+            for name, preset, num_columns in tray_specs]
+
+
+def parse_tray(value):
+    """Parse a --tray PRESET[:COLUMNS] value."""
+    preset, _, columns = value.partition(':')
+    try:
+        return int(preset), int(columns) if columns else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected PRESET or PRESET:COLUMNS, got {value!r}")
+
+
+def run_batch(image_paths, conversion_factor, label_preset, output_path, params, workers=None, render_dir=None,
+              cache_dir=None, profile_path=None):
+    """
+    Process images across a process pool and write one combined results table.
+
+    Rows are written in the order of image_paths, whatever order the workers
+    finish in, and streamed to the output as each image completes. A failing
+    image is logged and recorded without stopping the run, and so is an
+    image whose worker died (out of memory, crash in native code): the pool
+    is started again for the images still to process.
+
+    Args:
+    image_paths (list): Images to process.
+    conversion_factor (float or list): Factor to convert pixel to real-world units, or one factor per image (None
+        to calibrate that image from its own marker, see process_one).
+    label_preset (int): Label preset passed to choose_label.
+    output_path (str): Output file, CSV, JSON Lines (.jsonl) or Parquet (.parquet) by extension.
+    params (dict): Segmentation parameters, see params_from_args.
+    workers (int): Number of worker processes, defaults to the CPU count.
+    render_dir (str): Directory for rendered images, None to skip rendering.
+    cache_dir (str): Result cache directory, None to disable caching.
+    profile_path (str): Write per-image stage timings to this JSON file, None to disable profiling.
+
+    Returns:
+    int: Number of images that failed.
+    """
+    failures = 0
+    profiles = []
+    n = len(image_paths)
+    factors = conversion_factor if isinstance(conversion_factor, list) else [conversion_factor] * n
+
+    def submit(executor, idx):
+        return executor.submit(process_one, image_paths[idx], factors[idx], label_preset, params, render_dir,
+                               cache_dir, profile_path is not None)
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        with RecordWriter(output_path) as writer:
+            futures = [submit(executor, idx) for idx in range(n)]
+            for idx, image_path in enumerate(image_paths):
+                try:
+                    _, records, error, profile_data = futures[idx].result()
+                except BrokenProcessPool as e:
+                    records, error, profile_data = [], f'{type(e).__name__}: {str(e).strip()}', None
+                    # Every pending image failed with the pool, submit them again to a new one
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=workers)
+                    for later in range(idx + 1, n):
+                        if not futures[later].done() or futures[later].exception() is not None:
+                            futures[later] = submit(executor, later)
+                except Exception as e:
+                    records, error, profile_data = [], f'{type(e).__name__}: {str(e).strip()}', None
+                # Results are not kept once written
+                futures[idx] = None
+
+                name = os.path.basename(image_path)
+                if error:
+                    failures += 1
+                    logging.error('%s failed: %s', image_path, error)
+                    records = region_records(name, [], factors[idx], params, error=error)
+                writer.write_all(records)
+                if profile_data is not None:
+                    profiles.append({'image': image_path, **profile_data})
+                print(f'[{idx + 1}/{n}] {name}' + (' FAILED' if error else ''), file=sys.stderr)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    if profile_path:
+        with open(profile_path, 'w') as file:
+            json.dump({'images': profiles}, file, indent=2)
+    return failures
+
+
+def add_processing_arguments(parser):
+    """Add the calibration and segmentation options shared by batch.py and watch.py."""
+    scale = parser.add_mutually_exclusive_group(required=True)
+    scale.add_argument('-c', '--conversion-factor', type=float, default=None,
+                       help='Real-world size of one pixel (cm/pixel).')
+    scale.add_argument('--marker-size', type=float, default=None, metavar='CM',
+                       help='Calibrate from the dark square reference marker of this side (cm) in the photos, once '
+                            'per camera rig.')
+    parser.add_argument('--rig', default=None,
+                        help='Name of the camera setup the calibration is saved under, recognized from the EXIF '
+                             'camera model by default. Photos without either are calibrated one by one.')
+    parser.add_argument('--recalibrate', action='store_true',
+                        help='Measure the marker again instead of using the saved calibration of the rig.')
+    parser.add_argument('--calibration-file', default=CALIBRATION_FILE,
+                        help='Where the calibration of every rig is saved.')
+    parser.add_argument('-p', '--preset', type=int, default=1, help='Label preset.')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes.')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Reuse measurements of unchanged images with the same parameters from this directory.')
+    parser.add_argument('--tile-height', type=int, default=None,
+                        help='Segment images taller than this many rows in strips to bound memory use '
+                             '(ignored with --render-dir).')
+    parser.add_argument('--lower-green', type=int, nargs=3, default=(35, 52, 72), metavar=('H', 'S', 'V'))
+    parser.add_argument('--upper-green', type=int, nargs=3, default=(102, 255, 255), metavar=('H', 'S', 'V'))
+    parser.add_argument('--min-area', type=int, default=1000)
+    parser.add_argument('--dilation-kernel-size', type=int, default=50)
+    parser.add_argument('--max-regions', type=int, default=24, help='Maximum number of plants per tray.')
+    parser.add_argument('--grid-size', type=int, default=6)
+    parser.add_argument('--num-columns', type=int, default=4)
+    parser.add_argument('--tray', type=parse_tray, action='append', default=None, metavar='PRESET[:COLUMNS]',
+                        help='Photos hold several trays side by side: give one --tray per tray, from left to right. '
+                             'Labels are prefixed with the tray letter (A, B, ...).')
+
+
+def params_from_args(args):
+    """Collect the segmentation parameters passed to process_one from parsed arguments."""
+    return {
+        'lower_green': tuple(args.lower_green),
+        'upper_green': tuple(args.upper_green),
+        'min_area': args.min_area,
+        'dilation_kernel_size': (args.dilation_kernel_size, args.dilation_kernel_size),
+        'max_regions': args.max_regions,
+        'grid_size': args.grid_size,
+        'num_columns': args.num_columns,
+        'tile_height': args.tile_height,
+        'marker_size': args.marker_size,
+        # (name, preset, num_columns) of every tray, picklable for the worker processes
+        'trays': [(chr(ord('A') + idx), preset, columns or args.num_columns)
+                  for idx, (preset, columns) in enumerate(args.tray)] if args.tray else None,
+    }
+
+
+def calibrator_from_args(args):
+    """Build the marker Calibrator of the parsed arguments, None when a fixed conversion factor is given."""
+    if args.conversion_factor is not None:
+        return None
+    from calibration import Calibrator
+
+    return Calibrator(args.marker_size, args.calibration_file, args.rig, args.recalibrate)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Measure leaf areas for a folder of plate photos.')
+    parser.add_argument('inputs', nargs='+', help='Image files, directories or glob patterns.')
+    parser.add_argument('-o', '--output', default='results.csv',
+                        help='Output file: .csv, .jsonl or .parquet (needs pyarrow).')
+    parser.add_argument('--render-dir', default=None,
+                        help='Also save the verification grid and annotated image of each photo here.')
+    parser.add_argument('--profile', default=None, metavar='JSON',
+                        help='Write per-image stage timings and array allocations to this file.')
+    add_processing_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if os.path.splitext(args.output)[1].lower() not in FORMATS:
+        print(f"Unknown output format {args.output}, use one of {', '.join(FORMATS)}", file=sys.stderr)
+        return 1
+
+    image_paths = collect_images(args.inputs)
+    if not image_paths:
+        print('No images found.', file=sys.stderr)
+        return 1
+
+    params = params_from_args(args)
+    if args.render_dir:
+        os.makedirs(args.render_dir, exist_ok=True)
+
+    calibrator = calibrator_from_args(args)
+    conversion_factor = calibrator.rig_factors(image_paths) if calibrator else args.conversion_factor
+    try:
+        failures = run_batch(image_paths, conversion_factor, args.preset, args.output, params, args.workers,
+                             args.render_dir, args.cache_dir, args.profile)
+    except ImportError as e:
+        # Parquet output without pyarrow
+        print(e, file=sys.stderr)
+        return 1
+    print(f'Processed {len(image_paths)} images, {failures} failed. Results written to {args.output}',
+          file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
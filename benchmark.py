@@ -0,0 +1,218 @@
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+# Synthetic tray colors (BGR): brown soil and leaf green
+BACKGROUND_COLOR = (60, 90, 130)
+LEAF_COLOR = (40, 170, 60)
+
+DEFAULT_SIZES = (2, 8, 24, 50, 100)  # Megapixels
+DEFAULT_REGION_COUNTS = (1, 24, 96, 200)
+
+# Allowed relative area error per encoding. PNG keeps the exact edges, JPEG
+# artifacts blur them, which costs small plants (200 per tray) up to 10%
+TOLERANCES = {'png': 0.05, 'jpg': 0.15}
+
+
+def make_tray(megapixels, num_regions, seed=0):
+    """
+    Generate a synthetic tray photo with known leaf areas.
+
+    Plants are clusters of overlapping ellipses, one per cell of a 3:4 grid,
+    with enough soil between cells for the default dilation to keep them apart.
+
+    Args:
+    megapixels (float): Image size in millions of pixels (4:3 portrait).
+    num_regions (int): Number of plants.
+    seed (int): Random seed.
+
+    Returns:
+    tuple: BGR image, list of ((center_x, center_y), pixel_area) ground truth, and the cell size in pixels.
+    """
+    rng = np.random.default_rng(seed)
+    width = int(math.sqrt(megapixels * 1e6 * 3 / 4))
+    height = int(width * 4 / 3)
+    columns = max(1, round(math.sqrt(num_regions * 3 / 4)))
+    rows = math.ceil(num_regions / columns)
+    cell = min(width // columns, height // rows)
+
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = BACKGROUND_COLOR
+    plant = np.zeros((cell, cell), np.uint8)
+
+    truth = []
+    for idx in range(num_regions):
+        row, col = divmod(idx, columns)
+        x0 = col * cell
+        y0 = row * cell
+
+        # Leaves stay within the middle half of the cell
+        plant[:] = 0
+        for _ in range(int(rng.integers(2, 5))):
+            center = (int(cell / 2 + rng.uniform(-0.08, 0.08) * cell), int(cell / 2 + rng.uniform(-0.08, 0.08) * cell))
+            axes = (int(rng.uniform(0.05, 0.15) * cell) + 1, int(rng.uniform(0.05, 0.15) * cell) + 1)
+            cv2.ellipse(plant, center, axes, float(rng.uniform(0, 180)), 0, 360, 255, -1)
+
+        image[y0:y0 + cell, x0:x0 + cell][plant > 0] = LEAF_COLOR
+        truth.append(((x0 + cell // 2, y0 + cell // 2), int(np.count_nonzero(plant))))
+
+    return image, truth, cell
+
+
+def peak_rss_mb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def run_case(image_path, truth, cell, dilation_kernel_size, render, repeat):
+    """
+    Time every pipeline stage on one image, in a fresh worker process.
+
+    Stage timings come from the profiling hooks of process_image (or
+    measure_image without rendering). The repeats share a Workspace, as the
+    images of a batch worker do.
+
+    Returns:
+    dict: Best time per stage over the repeats (seconds), peak RSS and the area check.
+    """
+    import image_processing
+    from profiling import StageReport
+    from workspace import Workspace
+
+    num_regions = len(truth)
+    label_mapping = {i: f'P{i}' for i in range(1, num_regions + 1)}
+    params = ((35, 52, 72), (102, 255, 255), 1000, dilation_kernel_size, num_regions)
+    timings = {}
+    workspace = Workspace()
+
+    for _ in range(repeat):
+        report = StageReport()
+        if render:
+            grid_size = math.ceil(num_regions / 4)
+            image_processing.process_image(image_path, 1.0, label_mapping, *params, grid_size, 4, report=report,
+                                           workspace=workspace)
+        else:
+            image_processing.measure_image(image_path, 1.0, label_mapping, *params, report=report, workspace=workspace)
+        for entry in report.stages:
+            timings[entry['name']] = min(timings.get(entry['name'], entry['seconds']), entry['seconds'])
+
+    regions = image_processing.measure_image(image_path, 1.0, label_mapping, *params)
+
+    # Match every true plant to the measured region centered in its cell
+    errors = []
+    centers = np.array([region['center'][::-1] for region in regions], dtype=float).reshape(-1, 2)
+    for (center, true_area) in truth:
+        if len(centers) == 0:
+            break
+        distances = np.abs(centers - center).max(axis=1)
+        nearest = np.argmin(distances)
+        if distances[nearest] < cell / 2:
+            errors.append(abs(regions[nearest]['pixel_area'] - true_area) / true_area)
+
+    return {
+        'timings': timings,
+        'total': sum(timings.values()),
+        'peak_rss_mb': peak_rss_mb(),
+        'detected': len(regions),
+        'matched': len(errors),
+        'max_area_error': max(errors) if errors else None,
+    }
+
+
+def run_benchmark(sizes, region_counts, repeat=3, render=True, tolerance=None, image_format='png', seed=0):
+    """
+    Benchmark the pipeline over every combination of image size and region count.
+
+    JPEG artifacts blur the leaf edges, the jpg format times a realistic
+    decode but its area check is looser (see TOLERANCES).
+
+    Returns:
+    dict: Environment description and one result per case.
+    """
+    if tolerance is None:
+        tolerance = TOLERANCES[image_format]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for megapixels in sizes:
+            for num_regions in region_counts:
+                image, truth, cell = make_tray(megapixels, num_regions, seed)
+                image_path = os.path.join(tmp_dir, f'tray_{megapixels}mp_{num_regions}.{image_format}')
+                cv2.imwrite(image_path, image, [cv2.IMWRITE_JPEG_QUALITY, 95] if image_format == 'jpg' else [])
+                height, width = image.shape[:2]
+                del image
+
+                # Keep the dilation smaller than the soil between plants
+                kernel_size = min(50, cell // 4)
+
+                # A fresh process per case so peak RSS belongs to this case only
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    case = executor.submit(run_case, image_path, truth, cell, (kernel_size, kernel_size), render,
+                                           repeat).result()
+
+                case.update({
+                    'megapixels': megapixels,
+                    'width': width,
+                    'height': height,
+                    'regions': num_regions,
+                    'dilation_kernel_size': kernel_size,
+                })
+                case['areas_ok'] = (case['matched'] == num_regions and case['max_area_error'] <= tolerance)
+                results.append(case)
+                print(f"{megapixels:>5} MP {num_regions:>4} regions: {case['total']:.3f} s, "
+                      f"{case['peak_rss_mb']:.0f} MB peak, matched {case['matched']}/{num_regions}, "
+                      f"max area error {case['max_area_error'] or 0:.2%}" + ('' if case['areas_ok'] else ' FAIL'),
+                      file=sys.stderr)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'parameters': {'repeat': repeat, 'render': render, 'tolerance': tolerance, 'format': image_format,
+                       'seed': seed},
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the leaf area pipeline on synthetic trays.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES, help='Image sizes in megapixels.')
+    parser.add_argument('--regions', type=int, nargs='+', default=DEFAULT_REGION_COUNTS, help='Plants per image.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the fastest is kept.')
+    parser.add_argument('--no-render', action='store_true', help='Skip the rendering stage.')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='Allowed relative area error, 5%% for png and 15%% for jpg by default.')
+    parser.add_argument('--format', choices=('jpg', 'png'), default='png', help='Encoding of the synthetic images.')
+    parser.add_argument('-o', '--output', default=None, help='Write the JSON results here instead of stdout.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_benchmark(args.sizes, args.regions, args.repeat, not args.no_render, args.tolerance, args.format)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0 if all(case['areas_ok'] for case in report['results']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
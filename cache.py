@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Bump whenever the measurement algorithm changes so stale results are not reused
+CACHE_VERSION = 5
+
+# The directory is listed again after this many stores, to account for what other processes sharing it wrote
+RESCAN_INTERVAL = 100
+# Eviction frees space down to this share of max_bytes, so a full cache is not listed again on every store
+EVICT_TO = 0.9
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 of a file's content.
+
+    Args:
+    file_path (str): Path to the file.
+    chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+    str: Hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of measurement results keyed by image content and parameters.
+
+    Each entry is a JSON file with the region list and, when store_masks is
+    set, an .npz file with the green and dilated masks. Hits refresh the
+    entry's modification time and the least recently used entries (regions
+    and masks together) are evicted once the directory grows past max_bytes,
+    down to EVICT_TO of it. The size of the directory is kept as a running
+    total, it is only listed again when the total crosses max_bytes or every
+    RESCAN_INTERVAL stores. Writes go through a temporary file and
+    os.replace, so concurrent batch workers can share one directory.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 ** 2, store_masks=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store_masks = store_masks
+        os.makedirs(directory, exist_ok=True)
+        # Bytes in the directory as of the last listing plus what this instance stored since, None before a listing
+        self._total = None
+        self._puts = 0
+
+    def make_key(self, image_path, conversion_factor, label_mapping, lower_green, upper_green, min_area,
+                 dilation_kernel_size, max_regions, num_columns=None, trays=None):
+        """
+        Build the cache key for an image and the exact parameters it is measured with.
+
+        Returns:
+        str: Hex digest identifying the entry.
+        """
+        params = (
+            CACHE_VERSION,
+            float(conversion_factor),
+            sorted(label_mapping.items()),
+            tuple(int(v) for v in lower_green),
+            tuple(int(v) for v in upper_green),
+            int(min_area),
+            tuple(int(v) for v in dilation_kernel_size),
+            max_regions,
+            num_columns,
+            [(tray['name'], sorted(tray['label_mapping'].items()), tray['num_columns']) for tray in trays or ()],
+        )
+        digest = hashlib.sha256(hash_file(image_path).encode())
+        digest.update(repr(params).encode())
+        return digest.hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def get(self, key):
+        """
+        Look up the regions stored for a key.
+
+        Returns:
+        list: Region dicts, or None on a miss.
+        """
+        path = self._path(key, '.json')
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        self._touch(key)
+        # JSON has no tuples, restore them for the coordinate fields
+        return [{k: tuple(v) if isinstance(v, list) else v for k, v in region.items()} for region in data['regions']]
+
+    def get_masks(self, key):
+        """
+        Look up the masks stored for a key.
+
+        Returns:
+        tuple: Green mask and dilated mask, or None on a miss.
+        """
+        try:
+            with np.load(self._path(key, '.npz')) as data:
+                return data['mask'], data['dilated_mask']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, regions, masks=None):
+        """
+        Store the regions (and masks, if enabled) for a key, then evict old entries.
+
+        Args:
+        key (str): Key from make_key.
+        regions (list): Region dicts from measure_regions.
+        masks (tuple): Optional green mask and dilated mask.
+        """
+        written = 0
+        if masks is not None and self.store_masks:
+            mask, dilated_mask = masks
+            written += self._write_atomic(
+                key, '.npz', lambda file: np.savez_compressed(file, mask=mask, dilated_mask=dilated_mask))
+        data = json.dumps({'regions': regions}, default=int).encode()
+        written += self._write_atomic(key, '.json', lambda file: file.write(data))
+
+        self._puts += 1
+        if self._total is not None:
+            self._total += written
+        if self._total is None or self._total > self.max_bytes or self._puts % RESCAN_INTERVAL == 0:
+            self.evict()
+
+    def _write_atomic(self, key, extension, write):
+        # Returns the size of the written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                write(file)
+                size = file.tell()
+            os.replace(tmp_path, self._path(key, extension))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return size
+
+    def _touch(self, key):
+        for extension in ('.json', '.npz'):
+            try:
+                os.utime(self._path(key, extension))
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove least recently used entries, with their masks, once the cache is over max_bytes."""
+        # key -> [last use, size, paths]
+        entries = {}
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                key, extension = os.path.splitext(entry.name)
+                if extension in ('.json', '.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    item = entries.setdefault(key, [0.0, 0, []])
+                    item[0] = max(item[0], stat.st_mtime)
+                    item[1] += stat.st_size
+                    if extension == '.json':
+                        # Removed first, so a lookup never finds the regions without their masks
+                        item[2].insert(0, entry.path)
+                    else:
+                        item[2].append(entry.path)
+                    total += stat.st_size
+
+        if total > self.max_bytes:
+            for _, size, paths in sorted(entries.values()):
+                if total <= EVICT_TO * self.max_bytes:
+                    break
+                for path in paths:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                total -= size
+        self._total = total
@@ -0,0 +1,297 @@
+import json
+import math
+import os
+from datetime import datetime
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from config import CALIBRATION_FILE
+from utils import save_json
+
+# Size of the image the marker is searched in before it is refined at full resolution
+SEARCH_SIZE = (1600, 1600)
+# Smallest marker side searched for, in pixels of the search image
+MIN_MARKER_SIDE = 12
+# Largest ratio between the longest and the shortest side of the marker
+MAX_SIDE_RATIO = 1.2
+# Largest |cos| of the corner angles, about 10 degrees away from square
+MAX_CORNER_COS = 0.17
+# Share of the marker that must be dark, and how much brighter its surroundings must be
+MIN_FILL = 0.95
+MIN_CONTRAST = 60
+
+# EXIF tags identifying the camera
+EXIF_MAKE = 0x010F
+EXIF_MODEL = 0x0110
+EXIF_IFD = 0x8769
+EXIF_FOCAL_LENGTH = 0x920A
+
+
+def find_markers(gray, min_side=MIN_MARKER_SIDE):
+    """
+    Find solid dark squares on a lighter background.
+
+    Dark shapes are outlined at Otsu's threshold and simplified with
+    approxPolyDP. Convex quadrilaterals with nearly equal sides and right
+    angles are kept if they are almost entirely dark inside and clearly
+    brighter around, which rules out tray cells and pots of soil.
+
+    Args:
+    gray (numpy.ndarray): Grayscale image.
+    min_side (int): Smallest side in pixels.
+
+    Returns:
+    list: (4, 2) float32 corner arrays, largest marker first.
+    """
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, dark = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(dark, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+
+    markers = []
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if area < min_side ** 2 or area > 0.25 * gray.size:
+            continue
+        corners = cv2.approxPolyDP(contour, 0.03 * cv2.arcLength(contour, True), True)
+        if len(corners) != 4 or not cv2.isContourConvex(corners):
+            continue
+        corners = corners.reshape(4, 2).astype(np.float32)
+
+        edges = np.roll(corners, -1, axis=0) - corners
+        sides = np.linalg.norm(edges, axis=1)
+        if sides.max() > MAX_SIDE_RATIO * sides.min():
+            continue
+        cosines = np.abs(np.sum(edges * np.roll(edges, -1, axis=0), axis=1)) / (sides * np.roll(sides, -1))
+        if cosines.max() > MAX_CORNER_COS:
+            continue
+
+        # Solid inside, bright ring of a quarter side around it
+        x, y, w, h = cv2.boundingRect(corners)
+        margin = int(sides.mean() / 4) + 1
+        x0, y0 = max(x - margin, 0), max(y - margin, 0)
+        x1, y1 = min(x + w + margin, gray.shape[1]), min(y + h + margin, gray.shape[0])
+        inside = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.fillConvexPoly(inside, np.rint(corners - (x0, y0)).astype(np.int32), 1)
+        ring = cv2.dilate(inside, np.ones((2 * margin + 1, 2 * margin + 1), np.uint8)) - inside
+        inside = cv2.erode(inside, np.ones((3, 3), np.uint8)).astype(bool)
+        ring = ring.astype(bool)
+        if not inside.any() or not ring.any():
+            continue
+        crop, crop_dark = blurred[y0:y1, x0:x1], dark[y0:y1, x0:x1]
+        if np.count_nonzero(crop_dark[inside]) < MIN_FILL * np.count_nonzero(inside):
+            continue
+        if crop[ring].mean() - crop[inside].mean() < MIN_CONTRAST:
+            continue
+        markers.append((area, corners))
+
+    markers.sort(key=lambda item: -item[0])
+    return [corners for _, corners in markers]
+
+
+def marker_area(gray, corners):
+    """
+    Area of a dark marker with subpixel accuracy.
+
+    Pixels near the outline are partly covered by the marker, each counts
+    for where its gray level lies between the dark inside and the bright
+    surroundings. Unlike the outline corners, this does not depend on the
+    threshold or on how blurry the edges are.
+
+    Args:
+    gray (numpy.ndarray): Grayscale image around the marker.
+    corners (numpy.ndarray): (4, 2) approximate corners.
+
+    Returns:
+    float: Area in pixels.
+    """
+    side = np.linalg.norm(np.roll(corners, -1, axis=0) - corners, axis=1).mean()
+    # Wide enough for blurred edges, narrow enough to keep the texture of the background out
+    margin = max(int(side / 40), 3)
+    kernel = np.ones((2 * margin + 1, 2 * margin + 1), np.uint8)
+    polygon = np.zeros(gray.shape, dtype=np.uint8)
+    cv2.fillConvexPoly(polygon, np.rint(corners).astype(np.int32), 1)
+    outline = cv2.dilate(polygon, kernel)
+    ring = cv2.dilate(outline, kernel) - outline
+
+    dark = np.median(gray[cv2.erode(polygon, kernel).astype(bool)])
+    bright = np.median(gray[ring.astype(bool)])
+    coverage = (bright - gray[outline.astype(bool)].astype(np.float64)) / (bright - dark)
+    return float(np.clip(coverage, 0, 1).sum())
+
+
+def measure_marker(image_source, marker_size):
+    """
+    Compute the conversion factor of an image from the square reference marker in it.
+
+    The marker is searched in a downscaled copy, then outlined again and
+    measured in a full resolution crop around it, so the search stays fast
+    on large photos without losing precision.
+
+    Args:
+    image_source (ImageSource): Image to calibrate.
+    marker_size (float): Side of the marker (cm).
+
+    Returns:
+    float: Real-world size of one pixel (cm/pixel), None when no marker was found.
+    """
+    proxy = image_source.proxy(SEARCH_SIZE)
+    markers = find_markers(cv2.cvtColor(proxy, cv2.COLOR_BGR2GRAY))
+    if not markers:
+        return None
+
+    corners = markers[0] * (image_source.size[0] / proxy.shape[1])
+    side = np.linalg.norm(np.roll(corners, -1, axis=0) - corners, axis=1).mean()
+    x, y, w, h = cv2.boundingRect(corners)
+    margin = int(side / 2)
+    x0, y0 = max(x - margin, 0), max(y - margin, 0)
+    gray = cv2.cvtColor(image_source.full()[y0:y + h + margin, x0:x + w + margin], cv2.COLOR_BGR2GRAY)
+    corners -= (x0, y0)
+
+    # Outline the marker again at full resolution, the corners scaled up from the search image are too coarse
+    refined = find_markers(gray, min_side=int(side / 2))
+    if refined:
+        # The crop may hold another marker, keep the one found in the search image
+        center = corners.mean(axis=0)
+        corners = min(refined, key=lambda c: np.linalg.norm(c.mean(axis=0) - center))
+    return marker_size / math.sqrt(marker_area(gray, corners))
+
+
+def camera_rig(image_path):
+    """
+    Identify the camera setup an image was taken with from its EXIF data.
+
+    Returns:
+    str: Camera make and model, focal length and image size, None when the image has no camera information.
+    """
+    with Image.open(os.fspath(image_path)) as img:
+        exif = img.getexif()
+        size = img.size
+        # Rotated shots of the same rig get the same key
+        if exif.get(0x0112) in (5, 6, 7, 8):
+            size = size[::-1]
+        camera = ' '.join(str(exif.get(tag, '')).strip('\x00 ') for tag in (EXIF_MAKE, EXIF_MODEL)).strip()
+        if not camera:
+            return None
+        focal_length = exif.get_ifd(EXIF_IFD).get(EXIF_FOCAL_LENGTH)
+    rig = camera + (f' {float(focal_length):g}mm' if focal_length else '')
+    return f'{rig} {size[0]}x{size[1]}'
+
+
+class Calibrator:
+    """
+    Conversion factors from a square reference marker, cached per camera rig.
+
+    A rig is a fixed camera setup, named on the command line or recognized
+    from the EXIF camera model, focal length and image size. The marker is
+    measured in the first image of a rig it is found in, and every later
+    image of that rig (in this run and the next ones) reuses the factor
+    from the calibration file. Images that cannot be tied to a rig are
+    calibrated one by one from the marker in each of them.
+    """
+
+    def __init__(self, marker_size, path=CALIBRATION_FILE, rig=None, recalibrate=False):
+        """
+        Args:
+        marker_size (float): Side of the marker (cm).
+        path (str): JSON file holding the calibration of every rig.
+        rig (str): Name of the rig of every image, None to recognize it from EXIF data.
+        recalibrate (bool): Measure the marker again instead of using the saved calibrations.
+        """
+        self.marker_size = marker_size
+        self.path = path
+        self.rig = rig
+        try:
+            with open(path) as file:
+                self.rigs = json.load(file)
+        except FileNotFoundError:
+            self.rigs = {}
+        # Rigs measured in this run, the saved ones are only trusted if not recalibrating
+        self._fresh = set()
+        # Rigs whose marker was not found in this run, their images are calibrated one by one
+        self._failed = set()
+        self._recalibrate = recalibrate
+
+    def rig_of(self, image_path):
+        """Rig of an image, None when it is unknown."""
+        if self.rig:
+            return self.rig
+        try:
+            return camera_rig(image_path)
+        except OSError:
+            return None
+
+    def cached(self, rig):
+        """Saved conversion factor of a rig, None if it has not been calibrated with this marker size."""
+        entry = self.rigs.get(rig)
+        if entry is None or entry['marker_size'] != self.marker_size:
+            return None
+        if self._recalibrate and rig not in self._fresh:
+            return None
+        return entry['conversion_factor']
+
+    def conversion_factor(self, image_path):
+        """
+        Conversion factor of one image, from its rig or from the marker in it.
+
+        Args:
+        image_path (str or ImageSource): Image to calibrate.
+
+        Returns:
+        float: Real-world size of one pixel (cm/pixel), None when neither the rig nor the marker is known.
+        """
+        from image_processing import ImageSource
+
+        rig = self.rig_of(image_path)
+        factor = self.cached(rig) if rig is not None else None
+        if factor is not None:
+            return factor
+        source = image_path if isinstance(image_path, ImageSource) else ImageSource(os.fspath(image_path))
+        factor = measure_marker(source, self.marker_size)
+        if factor is not None and rig is not None:
+            self.save(rig, factor, os.path.basename(os.fspath(image_path)))
+        return factor
+
+    def rig_factors(self, image_paths):
+        """
+        Conversion factors of the images whose rig is known, calibrating new rigs on the way.
+
+        Images without a rig are left to per-image calibration in the workers,
+        and so are the images of a rig whose marker was not found in its first
+        image: the marker is searched for once per rig here, not once per image.
+
+        Returns:
+        list: Conversion factor of every image, None for the images to calibrate one by one.
+        """
+        factors = []
+        for image_path in image_paths:
+            rig = self.rig_of(image_path)
+            if rig is None or rig in self._failed:
+                factors.append(None)
+                continue
+            factor = self.conversion_factor(image_path)
+            if factor is None:
+                self._failed.add(rig)
+            factors.append(factor)
+        return factors
+
+    def save(self, rig, conversion_factor, image):
+        """Record the calibration of a rig and write the calibration file."""
+        self.rigs[rig] = {
+            'conversion_factor': conversion_factor,
+            'marker_size': self.marker_size,
+            'image': image,
+            'calibrated_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        self._fresh.add(rig)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        save_json(self.path, self.rigs, indent=1)
+
+
+def per_image_factor(image_source, marker_size):
+    """Conversion factor from the marker of one image, raising ValueError if there is none."""
+    factor = measure_marker(image_source, marker_size)
+    if factor is None:
+        raise ValueError(f"No {marker_size:g} cm reference marker found in {os.path.basename(image_source.path)}")
+    return factor
@@ -1,5 +1,21 @@
+import os
+import sys
+
 # Configuration and constants
 MAX_WINDOW_SIZE = (800, 600)
+
+# On-disk result cache used by the GUI (see cache.py)
+if sys.platform == 'darwin':
+    CACHE_DIR = os.path.expanduser('~/Library/Caches/Plante')
+else:
+    CACHE_DIR = os.path.expanduser('~/.cache/plante')
+CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# Conversion factors of the camera rigs calibrated from a reference marker (see calibration.py)
+if sys.platform == 'darwin':
+    CALIBRATION_FILE = os.path.expanduser('~/Library/Application Support/Plante/calibrations.json')
+else:
+    CALIBRATION_FILE = os.path.expanduser('~/.config/plante/calibrations.json')
 # Other constants...
 
 def choose_label(preset):
@@ -0,0 +1,179 @@
+import csv
+import json
+import os
+
+# Columns of the exported records. The first four match the original batch CSV.
+FIELDS = (
+    'image', 'label', 'area_cm2', 'error',
+    'tray', 'row', 'column', 'pixel_area',
+    'center_x', 'center_y', 'centroid_x', 'centroid_y',
+    'bbox_x', 'bbox_y', 'bbox_w', 'bbox_h',
+    'conversion_factor', 'lower_h', 'lower_s', 'lower_v', 'upper_h', 'upper_s', 'upper_v',
+    'min_area', 'dilation_kernel_size', 'max_regions', 'num_columns',
+)
+
+# Column types for Parquet, every other column is an integer
+STRING_FIELDS = {'image', 'label', 'error', 'tray'}
+FLOAT_FIELDS = {'area_cm2', 'centroid_x', 'centroid_y', 'conversion_factor'}
+
+# File extension to export format
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.parquet': 'parquet'}
+
+
+def parameter_fields(conversion_factor, params):
+    """Columns describing how an image was measured, shared by all its records."""
+    fields = {'conversion_factor': conversion_factor}
+    if params:
+        fields.update(zip(('lower_h', 'lower_s', 'lower_v'), params['lower_green']))
+        fields.update(zip(('upper_h', 'upper_s', 'upper_v'), params['upper_green']))
+        fields['min_area'] = params['min_area']
+        fields['dilation_kernel_size'] = params['dilation_kernel_size'][0]
+        fields['max_regions'] = params['max_regions']
+        fields['num_columns'] = params['num_columns']
+    return fields
+
+
+def region_records(image, regions, conversion_factor, params=None, empty=(), error=None):
+    """
+    Turn the regions measured in one image into flat export records.
+
+    Args:
+    image (str): Image name.
+    regions (list): Region dicts from measure_image.
+    conversion_factor (float): Factor the areas were converted with.
+    params (dict): Segmentation parameters, see batch.params_from_args.
+    empty (list): Labels of the empty cells, exported without an area.
+    error (str): Error message of a failed image, exported as a single record.
+
+    Yields:
+    dict: One record per region, then one per empty cell, with the FIELDS keys.
+    """
+    shared = parameter_fields(conversion_factor, params)
+    if error:
+        yield {'image': image, 'error': error, **shared}
+        return
+    for region in regions:
+        center_y, center_x = region['center']
+        bbox_x, bbox_y, bbox_w, bbox_h = region['bbox']
+        row, column = region.get('cell', (None, None))
+        yield {
+            'image': image,
+            'label': region['label'],
+            'area_cm2': region['area'],
+            'tray': region.get('tray') or None,
+            'row': row,
+            'column': column,
+            'pixel_area': region['pixel_area'],
+            'center_x': center_x,
+            'center_y': center_y,
+            'centroid_x': region['centroid'][0],
+            'centroid_y': region['centroid'][1],
+            'bbox_x': bbox_x,
+            'bbox_y': bbox_y,
+            'bbox_w': bbox_w,
+            'bbox_h': bbox_h,
+            **shared,
+        }
+    for label in empty:
+        yield {'image': image, 'label': label, **shared}
+
+
+class RecordWriter:
+    """
+    Stream records to a CSV, JSON Lines or Parquet file.
+
+    Records are written as they come, CSV and JSON Lines one line at a time
+    and Parquet one row group of row_group_size records at a time, so memory
+    use does not grow with the number of regions. Missing fields are empty
+    in CSV and null otherwise. Parquet needs pyarrow and cannot be appended
+    to.
+    """
+
+    def __init__(self, path, format=None, fields=FIELDS, row_group_size=10000, append=False):
+        """
+        Args:
+        path (str): Output file.
+        format (str): 'csv', 'jsonl' or 'parquet', guessed from the extension when None.
+        fields (tuple): Columns, in order.
+        row_group_size (int): Records per Parquet row group.
+        append (bool): Add to the records already in the file instead of replacing them (CSV and JSON Lines).
+        """
+        if format is None:
+            format = FORMATS.get(os.path.splitext(path)[1].lower())
+            if format is None:
+                raise ValueError(f"Unknown export format for {path}, use one of {', '.join(FORMATS)}")
+        self.format = format
+        self.fields = fields
+        self.row_group_size = row_group_size
+        self.count = 0
+
+        if format == 'parquet':
+            if append:
+                raise ValueError(f"Cannot append to the Parquet file {path}, use a .csv or .jsonl output")
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Parquet export needs pyarrow (pip install pyarrow)") from None
+            self._schema = pa.schema([(name, pa.string() if name in STRING_FIELDS else
+                                       pa.float64() if name in FLOAT_FIELDS else pa.int64()) for name in fields])
+            self._table = pa.Table
+            self._writer = pq.ParquetWriter(path, self._schema)
+            self._pending = []
+        elif format in ('csv', 'jsonl'):
+            new_file = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+            if format == 'csv' and not new_file:
+                # Appended rows must line up with the columns of the existing header
+                with open(path, newline='', encoding='utf-8') as file:
+                    header = next(csv.reader(file), [])
+                if tuple(header) != tuple(fields):
+                    raise ValueError(f"{path} has other columns than the records written to it, "
+                                     f"use a new output file")
+            self._file = open(path, 'w' if new_file else 'a', newline='' if format == 'csv' else None,
+                              encoding='utf-8')
+            if format == 'csv':
+                self._writer = csv.DictWriter(self._file, fields, extrasaction='ignore')
+                if new_file:
+                    self._writer.writeheader()
+        else:
+            raise ValueError(f"Unknown export format {format!r}")
+
+    def write(self, record):
+        self.count += 1
+        if self.format == 'csv':
+            self._writer.writerow(record)
+        elif self.format == 'jsonl':
+            self._file.write(json.dumps({name: record.get(name) for name in self.fields}) + '\n')
+        else:
+            self._pending.append(record)
+            if len(self._pending) >= self.row_group_size:
+                self._flush_row_group()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self.format == 'parquet':
+            self._flush_row_group()
+        else:
+            self._file.flush()
+
+    def close(self):
+        if self.format == 'parquet':
+            self._flush_row_group()
+            self._writer.close()
+        else:
+            self._file.close()
+
+    def _flush_row_group(self):
+        if self._pending:
+            columns = {name: [record.get(name) for record in self._pending] for name in self.fields}
+            self._writer.write_table(self._table.from_pydict(columns, schema=self._schema))
+            self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,270 @@
+import math
+
+import numpy as np
+
+# Largest tray rotation looked for, and the step of the search (degrees)
+MAX_SKEW = 10.0
+SKEW_STEP = 0.25
+# Largest correction of the searched angle taken from the slope of the rows
+MAX_REFINEMENT = 2.0
+# Pitches tried around the one from gap clustering, and rounds of lattice fitting in lattice_indices
+PITCH_RANGE = (0.8, 1.25)
+LATTICE_ROUNDS = 5
+
+
+def split_gap(gaps, min_gap=0.0):
+    """
+    Pick the gap width that separates clusters of sorted 1-D values.
+
+    The gaps between consecutive values fall into small ones (jitter within
+    a row or column) and large ones (the pitch between rows or columns).
+    The threshold between them is found with Otsu's method on the gaps.
+    When the gaps are all alike (a single row, or one plant per row) they
+    are all splits if they are wider than a plant (2 * min_gap) on average,
+    none otherwise.
+
+    Args:
+    gaps (numpy.ndarray): Differences between consecutive sorted values.
+    min_gap (float): Half the typical plant size, the smallest threshold allowed.
+
+    Returns:
+    float: Gaps wider than this start a new cluster.
+    """
+    if len(gaps) == 0:
+        return min_gap
+    gaps = np.sort(gaps)
+    n = len(gaps)
+    if n > 1:
+        cumulative = np.cumsum(gaps)
+        k = np.arange(1, n)
+        small_mean = cumulative[:-1] / k
+        large_mean = (cumulative[-1] - cumulative[:-1]) / (n - k)
+        best = int(np.argmax(k * (n - k) * (large_mean - small_mean) ** 2))
+        # Small gaps wider than a plant are pitches too, the large ones then come from empty rows
+        if large_mean[best] > 2 * small_mean[best] and (not min_gap or small_mean[best] <= 2 * min_gap):
+            return max(min_gap, (gaps[best] + gaps[best + 1]) / 2)
+    return min_gap if gaps.mean() > 2 * min_gap else np.inf
+
+
+def cluster_1d(values, min_gap=0.0):
+    """
+    Cluster 1-D values by splitting them at wide gaps.
+
+    Args:
+    values (numpy.ndarray): Values to cluster.
+    min_gap (float): See split_gap.
+
+    Returns:
+    tuple: Cluster index of every value (0 for the smallest values) and the mean of every cluster.
+    """
+    order = np.argsort(values, kind='stable')
+    gaps = np.diff(values[order])
+    breaks = np.concatenate(([0], np.cumsum(gaps > split_gap(gaps, min_gap))))
+    labels = np.empty(len(values), dtype=np.intp)
+    labels[order] = breaks
+    means = np.bincount(labels, weights=values) / np.bincount(labels)
+    return labels, means
+
+
+def grid_indices(labels, means):
+    """
+    Turn cluster indices into grid indices, leaving room for empty rows or columns.
+
+    The pitch is the typical distance between neighbouring clusters, a gap
+    of two pitches means one row (or column) has no plant at all.
+    """
+    if len(means) < 2:
+        return labels
+    # The regular spacing, with the wider gaps left by empty rows counted as several pitches
+    steps = np.diff(means)
+    pitch = np.median(steps)
+    pitch = np.median(steps / np.maximum(np.rint(steps / pitch), 1))
+    # Count the pitches step by step, so small errors in the pitch do not add up along the tray
+    positions = np.concatenate(([0], np.cumsum(np.maximum(np.rint(steps / pitch), 1)))).astype(np.intp)
+    return positions[labels]
+
+
+def lattice_indices(values, min_gap=0.0):
+    """
+    Place 1-D values on a regular lattice of rows (or columns).
+
+    Gap clustering (cluster_1d and grid_indices) gives a first pitch. It is
+    then refined as the period the values line up best with, within
+    PITCH_RANGE of the first one, and every value is assigned to the
+    nearest lattice line. The offset and pitch are fitted again to that
+    assignment by least squares until it no longer changes. A value is only
+    misplaced once it strays half a pitch from its line, where gap
+    clustering already fails when the jitter of two neighbouring rows closes
+    the gap between them.
+
+    Args:
+    values (numpy.ndarray): Values to place.
+    min_gap (float): See split_gap.
+
+    Returns:
+    numpy.ndarray: Lattice index of every value, 0 for the smallest values.
+    """
+    labels, means = cluster_1d(values, min_gap)
+    index = grid_indices(labels, means)
+    if index.max() == 0:
+        return index
+    pitch, _ = np.polyfit(index, values, 1)
+
+    # Alignment of the values on lattices of nearby pitches, fine enough that the phase drifts
+    # by a tenth of a pitch at most across the tray between two candidates
+    steps = int(np.ceil((PITCH_RANGE[1] - PITCH_RANGE[0]) * 10 * (index.max() + 1))) + 1
+    pitches = pitch * np.linspace(PITCH_RANGE[0], PITCH_RANGE[1], steps)
+    phases = np.exp(2j * np.pi * (values - values.min())[None, :] / pitches[:, None]).sum(axis=1)
+    best = int(np.argmax(np.abs(phases)))
+    pitch = pitches[best]
+    offset = values.min() + pitch * np.angle(phases[best]) / (2 * np.pi)
+
+    index = None
+    for _ in range(LATTICE_ROUNDS):
+        lattice = np.rint((values - offset) / pitch).astype(np.intp)
+        lattice -= lattice.min()
+        if index is not None and np.array_equal(lattice, index):
+            break
+        index = lattice
+        if index.max() == 0:
+            break
+        pitch, offset = np.polyfit(index, values, 1)
+    return index
+
+
+def aligned_pairs(values, distance):
+    """Count the pairs of values closer than distance."""
+    values = np.sort(values)
+    return int((np.searchsorted(values, values + distance) - np.arange(1, len(values) + 1)).sum())
+
+
+def deviations(values, groups):
+    """Deviation of every value from the mean of its group."""
+    # Lattice rows may be empty, only the occupied ones are indexed
+    return values - (np.bincount(groups, weights=values) / np.maximum(np.bincount(groups), 1))[groups]
+
+
+def rotate(points, angle):
+    """Rotate (x, y) points by -angle radians, returns the x and y arrays."""
+    cos, sin = math.cos(angle), math.sin(angle)
+    return points[:, 0] * cos + points[:, 1] * sin, points[:, 1] * cos - points[:, 0] * sin
+
+
+def fit_grid(centers, sizes=None, num_columns=None):
+    """
+    Assign region centers to the rows and columns of a tray.
+
+    The tray rotation is first searched for (up to MAX_SKEW degrees) as the
+    angle at which the centers line up in rows, then refined from the slope
+    of the rows. The rotated centers are placed on a regular lattice of
+    rows and columns (see lattice_indices), so rows or columns without any
+    plant are kept as empty. The angle search is O(n log n) in the number
+    of regions, the pitch search O(n) per row or column of the tray.
+
+    Args:
+    centers (numpy.ndarray): (N, 2) region centers as (x, y).
+    sizes (numpy.ndarray): (N, 2) region sizes as (w, h), half the median size is the smallest gap between rows and
+        columns. None to rely on the gaps only.
+    num_columns (int): Number of columns of the tray, None to use the number found.
+
+    Returns:
+    dict: 'cells' ((N, 2) row and column of every region), 'rows', 'columns' (num_columns when given) and the
+        estimated 'angle' in degrees.
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    if len(centers) == 0:
+        return {'cells': np.zeros((0, 2), dtype=np.intp), 'rows': 0, 'columns': num_columns or 0, 'angle': 0.0}
+    min_gap_x, min_gap_y = (0.5 * np.median(np.asarray(sizes, dtype=float).reshape(-1, 2), axis=0)
+                            if sizes is not None else (0.0, 0.0))
+
+    # Coarse rotation: the angle at which the most centers line up in rows and columns
+    angles = np.radians(np.arange(-MAX_SKEW, MAX_SKEW + SKEW_STEP / 2, SKEW_STEP))
+    scale = max(np.ptp(centers, axis=0).max(), 1.0) / (2 * math.sqrt(len(centers)))
+    alignment = [aligned_pairs(x, min_gap_x or scale) + aligned_pairs(y, min_gap_y or scale)
+                 for x, y in (rotate(centers, angle) for angle in angles)]
+    # Prefer the smallest rotation among equally good ones
+    angle = angles[np.lexsort((np.abs(angles), -np.asarray(alignment)))[0]]
+
+    # Refine with the least squares slope of the rows and columns, pooled over all of them
+    x, y = rotate(centers, angle)
+    for _ in range(2):
+        rows = lattice_indices(y, min_gap_y)
+        columns = lattice_indices(x, min_gap_x)
+        row_x, row_y = deviations(x, rows), deviations(y, rows)
+        column_x, column_y = deviations(x, columns), deviations(y, columns)
+        weight = np.dot(row_x, row_x) + np.dot(column_y, column_y)
+        if weight == 0:
+            break
+        correction = math.atan((np.dot(row_x, row_y) - np.dot(column_x, column_y)) / weight)
+        # A larger correction means the rows were not found, keep the coarse angle then
+        if abs(correction) > math.radians(MAX_REFINEMENT):
+            break
+        angle += correction
+        x, y = rotate(centers, angle)
+
+    row_index = lattice_indices(y, min_gap_y)
+    column_index = lattice_indices(x, min_gap_x)
+
+    return {
+        'cells': np.stack([row_index, column_index], axis=1),
+        'rows': int(row_index.max()) + 1,
+        'columns': num_columns or int(column_index.max()) + 1,
+        'angle': math.degrees(angle),
+    }
+
+
+def cell_label(label_mapping, row, column, num_columns):
+    """
+    Label of a grid cell, numbered row by row from 1 as in the label presets.
+
+    Cells past the end of the preset, or outside the tray columns, get a
+    row/column label instead of failing.
+    """
+    if column >= num_columns:
+        return f'R{row + 1}C{column + 1}'
+    return label_mapping.get(row * num_columns + column + 1, f'R{row + 1}C{column + 1}')
+
+
+def empty_cells(regions, label_mapping, num_columns=None):
+    """
+    List the grid cells without a region.
+
+    The tray is assumed to have at least as many cells as the label preset,
+    so missing plants in the last row are reported too.
+
+    Args:
+    regions (list): Region dicts with their 'cell'.
+    label_mapping (dict): Label preset of the tray.
+    num_columns (int): Number of columns of the tray, None to use the number found.
+
+    Returns:
+    list: Labels of the empty cells, in row order.
+    """
+    occupied = {tuple(region['cell']) for region in regions}
+    if not occupied:
+        return []
+    num_columns = num_columns or max(column for _, column in occupied) + 1
+    num_rows = max(max(row for row, _ in occupied) + 1, -(-len(label_mapping) // num_columns))
+    return [cell_label(label_mapping, row, column, num_columns)
+            for row in range(num_rows) for column in range(num_columns) if (row, column) not in occupied]
+
+
+def split_trays(x, count):
+    """
+    Split regions between trays placed side by side, at the widest gaps between them.
+
+    Args:
+    x (numpy.ndarray): Horizontal region centers.
+    count (int): Number of trays.
+
+    Returns:
+    list: count arrays of indices into x, one per tray from left to right.
+    """
+    order = np.argsort(x, kind='stable')
+    num_cuts = min(count - 1, max(len(x) - 1, 0))
+    if num_cuts == 0:
+        return [order] + [order[:0]] * (count - 1)
+    gaps = np.diff(x[order])
+    cuts = np.sort(np.argpartition(-gaps, num_cuts - 1)[:num_cuts]) + 1
+    groups = np.split(order, cuts)
+    return groups + [order[:0]] * (count - len(groups))
@@ -1,15 +1,394 @@
 from PIL import Image
 import cv2
 import io
+import os
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
 
+from grid import cell_label, empty_cells, fit_grid, split_trays
+from morphology import dilate
+from profiling import NULL_REPORT
+from workspace import Workspace
 
-def process_image(image_path, conversion_factor, label_mapping, lower_green=(35, 52, 72), upper_green=(102, 255, 255), 
-                  min_area=1000, dilation_kernel_size=(50, 50), max_regions=24, grid_size=6, num_columns=4):
-    
+# JPEG DCT-scaling decode modes, by reduction factor
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def load_image(image_path, reduction=1):
     """
-    Process the image and return processed data.
+    Decode an image file into a BGR array.
+
+    Args:
+    image_path (str or ImageSource): Path to the image. An ImageSource
+        returns its shared full resolution buffer.
+    reduction (int): Decode at 1/2, 1/4 or 1/8 of the resolution. JPEGs are
+        then decoded directly at the smaller size, which is much faster.
+
+    Returns:
+    numpy.ndarray: The decoded BGR image.
+    """
+    if isinstance(image_path, ImageSource) and reduction == 1:
+        return image_path.full()
+
+    image = cv2.imread(os.fspath(image_path), REDUCED_DECODE_FLAGS[reduction])
+    if image is None:
+        raise ValueError(f"Could not read image: {os.fspath(image_path)}")
+    return image
+
+
+class ImageSource:
+    """
+    An image file that is decoded at most once at full resolution.
+
+    The calibration window, the live preview and processing all work from
+    the same ImageSource, so the file is not decoded again for each of them.
+    Proxies are taken from the full resolution buffer once it exists and
+    otherwise decoded at reduced resolution. ImageSource is path-like, it
+    can be passed wherever an image path is expected.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._image = None
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __fspath__(self):
+        return self.path
+
+    @property
+    def size(self):
+        """(width, height) of the full resolution image, read from the file header only."""
+        if self._size is None:
+            if self._image is not None:
+                self._size = (self._image.shape[1], self._image.shape[0])
+            else:
+                with Image.open(self.path) as img:
+                    width, height = img.size
+                    # OpenCV applies the EXIF orientation, these tags swap the axes
+                    if img.getexif().get(0x0112) in (5, 6, 7, 8):
+                        width, height = height, width
+                self._size = (width, height)
+        return self._size
+
+    def full(self):
+        """Return the full resolution BGR image, decoding it on first use. Do not modify it."""
+        with self._lock:
+            if self._image is None:
+                self._image = load_image(self.path)
+                self._size = (self._image.shape[1], self._image.shape[0])
+            return self._image
+
+    def proxy(self, max_size):
+        """
+        Return a BGR image that fits in max_size, without a full decode when possible.
+
+        Args:
+        max_size (tuple): Maximum (width, height).
+
+        Returns:
+        numpy.ndarray: The downscaled BGR image (the full image if it already fits).
+        """
+        width, height = self.size
+        scale = min(1.0, max_size[0] / width, max_size[1] / height)
+
+        image = self._image
+        if image is None:
+            # Largest DCT reduction that still has enough pixels for the proxy
+            reduction = max(r for r in REDUCED_DECODE_FLAGS if r == 1 or scale * r <= 1)
+            image = load_image(self.path, reduction)
+
+        new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if (image.shape[1], image.shape[0]) == new_size:
+            return image
+        return cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
+
+
+def segment_image(image, lower_green=(35, 52, 72), upper_green=(102, 255, 255), dilation_kernel_size=(50, 50),
+                  report=NULL_REPORT, workspace=None):
+    """
+    Segment the green areas of a BGR image.
+
+    Args:
+    image (numpy.ndarray): BGR image.
+    lower_green (tuple): Lower HSV bound for green color segmentation.
+    upper_green (tuple): Upper HSV bound for green color segmentation.
+    dilation_kernel_size (tuple): Size of the kernel for dilation.
+    report (StageReport): Optional profiling report, see profiling.py.
+    workspace (Workspace): Optional buffers to write the masks into, see workspace.py.
+
+    Returns:
+    tuple: Green mask and dilated mask (both uint8, 0/255 and 0/1).
+    """
+    workspace = workspace or Workspace()
+    height, width = image.shape[:2]
+
+    # HSV for color segmentation
+    with report.stage('hsv'):
+        image_hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV,
+                                 dst=workspace.array('image_hsv', image.shape, report=report))
+
+    # Threshold the HSV image to get only green colors
+    with report.stage('in_range'):
+        mask = cv2.inRange(image_hsv, lower_green, upper_green,
+                           dst=workspace.array('mask', (height, width), report=report))
+
+    # Convert the mask to binary
+    with report.stage('binarize'):
+        _, binary_mask = cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY,
+                                       dst=workspace.array('binary_mask', (height, width), report=report))
+
+    # Perform a dilation operation to merge nearby green areas
+    with report.stage('dilate'):
+        # Rectangular kernel, see morphology.py
+        dilated_mask = dilate(binary_mask, dilation_kernel_size,
+                              dst=workspace.array('dilated_mask', (height, width), report=report))
+
+    return mask, dilated_mask
+
+
+def isolate_green(image, mask, report=NULL_REPORT, workspace=None):
+    """
+    Keep only the masked pixels of a BGR image, as RGB.
+
+    Args:
+    image (numpy.ndarray): BGR image.
+    mask (numpy.ndarray): Green mask from segment_image.
+    report (StageReport): Optional profiling report, see profiling.py.
+    workspace (Workspace): Optional buffers to write the result into, see workspace.py.
+
+    Returns:
+    numpy.ndarray: RGB image that is black outside the mask.
+    """
+    workspace = workspace or Workspace()
+    with report.stage('isolate'):
+        isolated_green = workspace.array('isolated_green', image.shape, report=report)
+        # A masked bitwise_and leaves the pixels outside the mask untouched, they must start black
+        isolated_green.fill(0)
+        cv2.bitwise_and(image, image, dst=isolated_green, mask=mask)
+        # Swap to RGB in place rather than converting the whole image to RGB first
+        cv2.cvtColor(isolated_green, cv2.COLOR_BGR2RGB, dst=isolated_green)
+    return isolated_green
+
+
+def component_stats(image, mask, dilated_mask, report=NULL_REPORT, workspace=None):
+    """
+    Measure every connected region of the dilated mask in a single pass.
+
+    Args:
+    image (numpy.ndarray): BGR image.
+    mask (numpy.ndarray): Green mask from segment_image.
+    dilated_mask (numpy.ndarray): Dilated mask from segment_image.
+    report (StageReport): Optional profiling report, see profiling.py.
+    workspace (Workspace): Optional buffers for the label image, see workspace.py.
+
+    Returns:
+    dict: Arrays indexed by region, without the background: 'x', 'y', 'w', 'h'
+        (bounding box), 'area' (dilated area), 'pixel_area' (green pixels),
+        'intensity' (sum of the green pixels' channel values) and 'centroid'
+        ((x, y) of the dilated region). 'labels' is the label image of the
+        dilated mask, region i has label i + 1 (in the workspace when one is given).
+    """
+    workspace = workspace or Workspace()
+    with report.stage('components'):
+        labels = workspace.array('labels', dilated_mask.shape, np.int32, report=report)
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(dilated_mask, labels=labels, connectivity=8)
+
+        # Only the green pixels contribute to area and intensity
+        green = np.flatnonzero(mask)
+        green_labels = labels.ravel()[green]
+        pixel_area = np.bincount(green_labels, minlength=n)
+        intensity = np.bincount(green_labels, weights=image.reshape(-1, 3)[green].sum(axis=1), minlength=n)
+        report.record('green_indices', green)
+        report.record('green_labels', green_labels)
+
+    return {
+        'x': stats[1:, cv2.CC_STAT_LEFT],
+        'y': stats[1:, cv2.CC_STAT_TOP],
+        'w': stats[1:, cv2.CC_STAT_WIDTH],
+        'h': stats[1:, cv2.CC_STAT_HEIGHT],
+        'area': stats[1:, cv2.CC_STAT_AREA],
+        'pixel_area': pixel_area[1:],
+        'intensity': intensity[1:],
+        'centroid': centroids[1:],
+        'labels': labels,
+    }
+
+
+def make_trays(label_mapping, num_columns=None, trays=None):
+    """
+    Describe the trays of a photo, a single unnamed tray unless trays is given.
+
+    Args:
+    label_mapping (dict): Label preset of the single tray.
+    num_columns (int): Number of columns of the single tray.
+    trays (list): Tray dicts with 'name', 'label_mapping' and 'num_columns', left to right.
+
+    Returns:
+    list: Tray dicts.
+    """
+    if trays:
+        return trays
+    return [{'name': '', 'label_mapping': label_mapping, 'num_columns': num_columns}]
+
+
+def tray_label(tray, label):
+    return f"{tray['name']}-{label}" if tray['name'] else label
+
+
+def select_regions(stats, conversion_factor, label_mapping, min_area=1000, max_regions=24, num_columns=None,
+                   trays=None, report=NULL_REPORT):
+    """
+    Rank, order and label the regions found by component_stats.
+
+    Regions are placed on the tray grid by grid.fit_grid and labeled by their
+    cell, so a missing plant leaves its cell empty instead of shifting the
+    labels of the following ones. With several trays side by side, the
+    regions are first split between them at the widest horizontal gaps and
+    every tray is ranked and labeled on its own.
+
+    Args:
+    stats (dict): Region arrays from component_stats.
+    conversion_factor (float): Factor to convert pixel to real-world units.
+    label_mapping (dict): Mapping from numeric labels to string labels.
+    min_area (int): Minimum area to consider for contour.
+    max_regions (int): Maximum number of regions per tray, None for no limit.
+    num_columns (int): Number of columns of the tray, None to use the number found.
+    trays (list): Trays of the photo, see make_trays. Their labels are
+        prefixed with the tray name. Overrides label_mapping and num_columns.
+    report (StageReport): Optional profiling report, see profiling.py.
+
+    Returns:
+    list: One dict per region with 'label', 'tray' (name), 'cell' (row,
+        column), 'center' (y, x), 'box' (x, y, w, h) of the display square,
+        'bbox' (x, y, w, h) of the region, 'centroid' (x, y), 'pixel_area',
+        'area' in real-world units and 'component' (index of the region in stats).
+    """
+    trays = make_trays(label_mapping, num_columns, trays)
+
+    with report.stage('ranking'):
+        candidates = np.flatnonzero(stats['area'] >= min_area)
+        centers_x = stats['x'][candidates] + stats['w'][candidates] // 2
+
+        # Keep the brightest green regions of every tray. A partial selection
+        # is enough, the grid fit sets the order.
+        selected = []
+        for group in split_trays(centers_x, len(trays)):
+            group = candidates[group]
+            if max_regions and len(group) > max_regions:
+                group = group[np.argpartition(-stats['intensity'][group], max_regions - 1)[:max_regions]]
+            selected.append(np.sort(group))
+        if not any(len(group) for group in selected):
+            return []
+
+        # Square of the maximum size centered on each region, used to display it
+        selected_all = np.concatenate(selected)
+        half = int(max(stats['w'][selected_all].max(), stats['h'][selected_all].max())) // 2
+
+    regions = []
+    with report.stage('grid_fit'):
+        for tray, group in zip(trays, selected):
+            if len(group):
+                regions.extend(_label_tray(stats, group, conversion_factor, tray, half))
+    return regions
+
+
+def _label_tray(stats, candidates, conversion_factor, tray, half):
+    w = stats['w'][candidates]
+    h = stats['h'][candidates]
+    centers = np.stack([stats['x'][candidates] + w // 2, stats['y'][candidates] + h // 2], axis=1)
+    # The centroid is less sensitive than the box to specks merged into a plant
+    fit = fit_grid(stats['centroid'][candidates], np.stack([w, h], axis=1), tray['num_columns'])
+    cells = fit['cells']
+
+    # Row by row, the largest region first when several fall in the same cell
+    order = np.lexsort((-stats['pixel_area'][candidates], cells[:, 1], cells[:, 0]))
+
+    regions = []
+    previous, duplicates = None, 0
+    for j in order:
+        i = candidates[j]
+        cell = (int(cells[j, 0]), int(cells[j, 1]))
+        label = cell_label(tray['label_mapping'], cell[0], cell[1], fit['columns'])
+        duplicates = duplicates + 1 if cell == previous else 0
+        if duplicates:
+            label = f'{label}.{duplicates + 1}'
+        previous = cell
+
+        center_x, center_y = (int(v) for v in centers[j])
+        pixel_area = int(stats['pixel_area'][i])
+        regions.append({
+            'label': tray_label(tray, label),
+            'tray': tray['name'],
+            'cell': cell,
+            'center': (center_y, center_x),
+            'box': (center_x - half, center_y - half, 2 * half, 2 * half),
+            'bbox': tuple(int(stats[k][i]) for k in ('x', 'y', 'w', 'h')),
+            'component': int(i),
+            'centroid': tuple(float(v) for v in stats['centroid'][i]),
+            'pixel_area': pixel_area,
+            'area': round(pixel_area*conversion_factor**2, 4),  # 4 decimal places
+        })
+    return regions
+
+
+def find_empty_cells(regions, label_mapping, num_columns=None, trays=None):
+    """
+    List the empty grid cells of every tray, see grid.empty_cells.
+
+    Returns:
+    list: Labels of the empty cells, tray by tray.
+    """
+    empty = []
+    for tray in make_trays(label_mapping, num_columns, trays):
+        tray_regions = [region for region in regions if region.get('tray', '') == tray['name']]
+        empty.extend(tray_label(tray, label)
+                     for label in empty_cells(tray_regions, tray['label_mapping'], tray['num_columns']))
+    return empty
+
+
+def measure_regions(image, mask, dilated_mask, conversion_factor, label_mapping, min_area=1000, max_regions=24,
+                    num_columns=None, trays=None, report=NULL_REPORT, workspace=None):
+    """
+    Locate, order and measure the plant regions of a segmented image.
+
+    Each region is a connected component of the dilated mask, its area is the
+    number of green pixels it contains.
+
+    Args:
+    image (numpy.ndarray): BGR image.
+    mask (numpy.ndarray): Green mask from segment_image.
+    dilated_mask (numpy.ndarray): Dilated mask from segment_image.
+    conversion_factor (float): Factor to convert pixel to real-world units.
+    label_mapping (dict): Mapping from numeric labels to string labels.
+    min_area (int): Minimum area to consider for contour.
+    max_regions (int): Maximum number of regions per tray, None for no limit.
+    num_columns (int): Number of columns of the tray, None to use the number found.
+    trays (list): Trays of the photo, see select_regions.
+    report (StageReport): Optional profiling report, see profiling.py.
+    workspace (Workspace): Optional reusable buffers, see workspace.py.
+
+    Returns:
+    list: Region dicts, see select_regions.
+    """
+    stats = component_stats(image, mask, dilated_mask, report, workspace)
+    return select_regions(stats, conversion_factor, label_mapping, min_area, max_regions, num_columns, trays, report)
+
+
+def measure_image(image_path, conversion_factor, label_mapping, lower_green=(35, 52, 72), upper_green=(102, 255, 255),
+                  min_area=1000, dilation_kernel_size=(50, 50), max_regions=24, num_columns=None, trays=None,
+                  cache=None, tile_height=None, report=NULL_REPORT, workspace=None):
+    """
+    Measure the plant regions of an image without rendering anything.
+
+    With tile_height set, images taller than that are segmented in strips
+    (see tiling.py) so only one strip's masks are in memory at a time. The
+    results are the same either way.
 
     Args:
     image_path (str): Path to the image.
@@ -19,169 +398,261 @@ def process_image(image_path, conversion_factor, label_mapping, lower_green=(35,
     upper_green (tuple): Upper HSV bound for green color segmentation.
     min_area (int): Minimum area to consider for contour.
     dilation_kernel_size (tuple): Size of the kernel for dilation.
-    max_regions (int): Maximum number of regions to process.
-    grid_size (int): Number of rows in the output grid.
-    num_columns (int): Number of columns in the output grid.
+    max_regions (int): Maximum number of regions per tray, None for no limit.
+    num_columns (int): Number of columns of the tray, None to use the number found.
+    trays (list): Trays of the photo, see select_regions.
+    cache (ResultCache): Optional result cache, see cache.py.
+    tile_height (int): Strip height for tiled processing, None to process the whole image at once.
+    report (StageReport): Optional profiling report, see profiling.py.
+    workspace (Workspace): Reusable buffers shared by successive calls, see workspace.py. None to allocate them for
+        this image only.
 
     Returns:
-    tuple: Processed image, text data, and verification plot.
+    list: Region dicts, see measure_regions.
     """
+    if cache is not None:
+        with report.stage('cache_lookup'):
+            key = cache.make_key(image_path, conversion_factor, label_mapping, lower_green, upper_green, min_area,
+                                 dilation_kernel_size, max_regions, num_columns, trays)
+            regions = cache.get(key)
+        if regions is not None:
+            return regions
+
+    with report.stage('decode'):
+        image = load_image(image_path)
+        report.record('image', image)
+
+    with (workspace or Workspace()).borrow() as workspace:
+        if tile_height and image.shape[0] > tile_height:
+            from tiling import component_stats_tiled
+
+            with report.stage('tiled_segmentation'):
+                stats = component_stats_tiled(image, lower_green, upper_green, dilation_kernel_size, tile_height,
+                                              workspace)
+            regions = select_regions(stats, conversion_factor, label_mapping, min_area, max_regions, num_columns,
+                                     trays, report)
+            masks = None  # Never assembled at full resolution
+        else:
+            mask, dilated_mask = segment_image(image, lower_green, upper_green, dilation_kernel_size, report, workspace)
+            regions = measure_regions(image, mask, dilated_mask, conversion_factor, label_mapping, min_area,
+                                      max_regions, num_columns, trays, report, workspace)
+            masks = (mask, dilated_mask)
+
+        # Written out before the workspace is reused
+        if cache is not None:
+            with report.stage('cache_store'):
+                cache.put(key, regions, masks)
+    return regions
+
+
+def format_regions(regions, empty=()):
+    """
+    Format measured regions as the text shown in the Data tab.
 
-    # Load the image
-    file_path = image_path
-    image = cv2.imread(file_path)
+    Args:
+    regions (list): Region dicts from measure_regions.
+    empty (list): Labels of the empty cells, see grid.empty_cells.
 
-    # Convert to RGB for matplotlib compatibility and HSV for color segmentation
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    image_hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    Returns:
+    str: One "label: area cm²" line per region, then one "label: empty" line per empty cell.
+    """
+    lines = [f"{region['label']}: {region['area']} cm²" for region in regions]
+    lines.extend(f"{label}: empty" for label in empty)
+    return '\n'.join(lines)
 
-    # Threshold the HSV image to get only green colors
-    mask = cv2.inRange(image_hsv, lower_green, upper_green)
 
-    # Bitwise-AND mask and original image to isolate the green area
-    isolated_green = cv2.bitwise_and(image_rgb, image_rgb, mask=mask)
+def render_region_grid(isolated_green, regions, grid_size=6, num_columns=4, report=NULL_REPORT):
+    """
+    Render the verification grid with one cropped panel per region.
 
-    # Convert the mask to binary
-    binary_mask = (mask > 0).astype(np.uint8)
+    Args:
+    isolated_green (numpy.ndarray): RGB image from isolate_green.
+    regions (list): Region dicts from measure_regions.
+    grid_size (int): Number of rows in the output grid.
+    num_columns (int): Number of columns in the output grid.
+    report (StageReport): Optional profiling report, see profiling.py.
 
-    # Perform a dilation operation to merge nearby green areas
-    kernel = np.ones(dilation_kernel_size, np.uint8)  # Adjust the kernel size as needed
-    dilated_mask = cv2.dilate(binary_mask, kernel, iterations=1)
-
-    # Find contours in the dilated mask
-    contours, _ = cv2.findContours(dilated_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Initialize a list to store the bounding rectangles of high-density regions
-    bounding_rectangles = []
-
-    # Find bounding rectangles for all high-density regions
-    for contour in contours:
-        area = cv2.contourArea(contour)
-        if area > 1000:
-            x, y, w, h = cv2.boundingRect(contour)
-            bounding_rectangles.append((x, y, w, h))
-
-    # Initialize a list to store the sum of pixel values for each rectangle
-    sum_pixel_values = []
-
-    # Calculate sum of pixel values for each rectangle and store it
-    for x, y, w, h in bounding_rectangles:
-        region = isolated_green[y:y+h, x:x+w]
-        sum_pixels = np.sum(region)
-        sum_pixel_values.append((x, y, w, h, sum_pixels))
-
-    # Sort bounding rectangles by the sum of pixel values in descending order
-    sum_pixel_values.sort(key=lambda rect: rect[4], reverse=True)
-
-    # Update the rest of the code to use the sorted sum_pixel_values
-    top_24_rectangles = [rect[:4] for rect in sum_pixel_values[:24]]
-
-    # Calculate the maximum square size among the 24 regions
-    max_square_size = max(max(w, h) for _, _, w, h in top_24_rectangles)
-
-    # Initialize a list to store the labeled regions with center coordinates
-    labeled_regions = []
-
-    # Draw squares of the maximum size centered at the calculated centers
-    for idx, (x, y, w, h) in enumerate(top_24_rectangles):
-        center_x = x + w // 2
-        center_y = y + h // 2
-        
-        # Calculate the coordinates for the square
-        x1 = center_x - max_square_size // 2
-        x2 = center_x + max_square_size // 2
-        y1 = center_y - max_square_size // 2
-        y2 = center_y + max_square_size // 2
-        
-        # Store the center along with the region
-        labeled_regions.append(((center_y, center_x), idx + 1, isolated_green[y1:y2, x1:x2]))
-
-    # Sort the regions by their center y-coordinate, then by their x-coordinate
-    labeled_regions.sort(key=lambda x: (x[0][0]))
-
-    # Group 4 by 4
-    for i in range(0, len(labeled_regions), 4):
-        labeled_regions[i:i+4] = sorted(labeled_regions[i:i+4], key=lambda x: x[0][1])
-
-    # Change the index to match the order
-    for i in range(len(labeled_regions)):
-        labeled_regions[i] = (labeled_regions[i][0], i+1, labeled_regions[i][2])
-
-
-    # Reconstruct each region tuple to include the surface area
-    labeled_regions_with_area = []
-    for region in labeled_regions:
-        center, label, region_image = region
-        non_zero_pixels = np.count_nonzero(region_image)*conversion_factor**2
-        # 4 decimal places
-        non_zero_pixels = round(non_zero_pixels, 4)
-        labeled_regions_with_area.append((center, label, region_image, non_zero_pixels))
-
-    # Plotting
-    # Limit the number of regions
-    labeled_regions_with_area = labeled_regions_with_area[:max_regions]
-
-    # Update the labels within labeled_regions_with_area
-    for i, (_, label, region, area) in enumerate(labeled_regions_with_area):
-        new_label = label_mapping[label]
-        labeled_regions_with_area[i] = ((_, new_label, region, area))
-
-    # Plotting with 6 rows and 4 columns
-    fig, axes = plt.subplots(grid_size, num_columns, figsize=(9,10))
-
-    for idx, (_, label, region, area) in enumerate(labeled_regions_with_area):
+    Returns:
+    PIL.Image: The rendered grid.
+    """
+    with report.stage('render_grid'):
+        return _render_region_grid(isolated_green, regions, grid_size, num_columns)
+
+
+def _render_region_grid(isolated_green, regions, grid_size, num_columns):
+    # Only needed for rendering, keep it out of the measurement path. The Figure
+    # API (rather than pyplot) draws off-screen and is safe on a worker thread.
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(9,10))
+    axes = fig.subplots(grid_size, num_columns, squeeze=False)
+
+    for idx, region in enumerate(regions[:grid_size * num_columns]):
         row = idx // num_columns  # Row index
         col = idx % num_columns   # Column index
-        
-        axes[row, col].imshow(region)
-        axes[row, col].set_title(f'{label}\nArea: {area} cm²')
+        x, y, w, h = region['box']
+
+        axes[row, col].imshow(isolated_green[max(y, 0):y+h, max(x, 0):x+w])
+        axes[row, col].set_title(f"{region['label']}\nArea: {region['area']} cm²")
         axes[row, col].axis('off')
 
     # Make sure to handle any additional subplots if the number of regions is less than the grid size
     total_plots = grid_size * num_columns
-    for idx in range(len(labeled_regions_with_area), total_plots):
+    for idx in range(len(regions), total_plots):
         row = idx // num_columns
         col = idx % num_columns
         axes[row, col].axis('off')
 
     # Adjust layout
-    plt.tight_layout()
-    
-    # Save the plot to a buffer with bbox_inches='tight' to include all content
+    fig.tight_layout()
+
+    # Save the plot to a buffer
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=90)
-    plt.close()
+    fig.savefig(buf, format='png', dpi=90)
     buf.seek(0)
-    img = Image.open(buf)
+    return Image.open(buf)
+
+
+def render_annotated_image(isolated_green, regions, report=NULL_REPORT, workspace=None):
+    """
+    Draw the labeled region squares on a copy of the isolated green image.
+
+    Args:
+    isolated_green (numpy.ndarray): RGB image from isolate_green.
+    regions (list): Region dicts from measure_regions.
+    report (StageReport): Optional profiling report, see profiling.py.
+    workspace (Workspace): Optional buffers for the copy, see workspace.py.
+
+    Returns:
+    PIL.Image: The annotated image.
+    """
+    workspace = workspace or Workspace()
+    with report.stage('render_annotated'):
+        squares_image = workspace.array('squares_image', isolated_green.shape, report=report)
+        np.copyto(squares_image, isolated_green)
+
+        for region in regions:
+            x1, y1, w, h = region['box']
+
+            # Draw the square
+            cv2.rectangle(squares_image, (x1, y1), (x1 + w, y1 + h), (0, 0, 255), 3)
+
+            # Draw the label with a larger font size
+            cv2.putText(squares_image, region['label'], (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 255), 3)
+
+        # Already RGB, PIL copies it out of the workspace
+        return Image.fromarray(squares_image)
+
+
+def process_image(image_path, conversion_factor, label_mapping, lower_green=(35, 52, 72), upper_green=(102, 255, 255), 
+                  min_area=1000, dilation_kernel_size=(50, 50), max_regions=24, grid_size=6, num_columns=4,
+                  trays=None, cache=None, progress=None, report=NULL_REPORT, workspace=None):
+    
+    """
+    Process the image and return processed data.
+
+    Measurement and rendering are separate stages, use measure_image when
+    only the numbers are needed.
 
-    # Create a copy of the isolated green image to draw squares on
-    squares_image = isolated_green.copy()
+    Args:
+    image_path (str): Path to the image.
+    conversion_factor (float): Factor to convert pixel to real-world units.
+    label_mapping (dict): Mapping from numeric labels to string labels.
+    lower_green (tuple): Lower HSV bound for green color segmentation.
+    upper_green (tuple): Upper HSV bound for green color segmentation.
+    min_area (int): Minimum area to consider for contour.
+    dilation_kernel_size (tuple): Size of the kernel for dilation.
+    max_regions (int): Maximum number of regions to process.
+    grid_size (int): Number of rows in the output grid.
+    num_columns (int): Number of columns in the output grid and of the tray.
+    trays (list): Trays of the photo, see select_regions.
+    cache (ResultCache): Optional result cache. When it holds the masks for
+        this image and parameters, only the decode and rendering run.
+    progress (callable): Optional progress(fraction, message) callback called
+        between stages. An exception raised by it aborts processing.
+    report (StageReport): Optional profiling report, see profiling.py.
+    workspace (Workspace): Reusable buffers shared by successive calls, see workspace.py. None to allocate them for
+        this image only.
 
-    # Iterate through labeled_regions_with_area and draw squares with labels
-    for (center, label, region_image, _) in labeled_regions_with_area:
-        center_y, center_x = center
-        h, w, _ = region_image.shape
+    Returns:
+    tuple: Processed image, text data, verification plot and the region dicts.
+    """
+    def annotate(image, mask, isolated_green, regions, workspace):
+        return render_annotated_image(isolated_green, regions, report, workspace)
 
-        # Calculate the coordinates for the square
-        x1 = center_x - w // 2
-        x2 = center_x + w // 2
-        y1 = center_y - h // 2
-        y2 = center_y + h // 2
+    return _process_image(image_path, conversion_factor, label_mapping, lower_green, upper_green, min_area,
+                          dilation_kernel_size, max_regions, grid_size, num_columns, trays, cache, progress, report,
+                          workspace, annotate)
 
-        # Draw the square
-        cv2.rectangle(squares_image, (x1, y1), (x2, y2), (255, 0, 0), 3)
-        
-        # Draw the label with a larger font size
-        cv2.putText(squares_image, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 0, 0), 3)
 
-    # Convert the second plot (OpenCV image with squares and labels) to a PIL Image
-    squares_image_rgb = cv2.cvtColor(squares_image, cv2.COLOR_BGR2RGB)  # Convert from BGR to RGB
-    plot_img2 = Image.fromarray(squares_image_rgb)
+def process_image_pyramid(image_path, conversion_factor, label_mapping, lower_green=(35, 52, 72),
+                          upper_green=(102, 255, 255), min_area=1000, dilation_kernel_size=(50, 50), max_regions=24,
+                          grid_size=6, num_columns=4, trays=None, cache=None, progress=None, report=NULL_REPORT,
+                          workspace=None):
+    """
+    Process the image for the zoomable viewer.
 
-    # Prepare text data
-    text_data = '\n'.join([f'{label}: {area} cm²' for _, label, _, area in labeled_regions_with_area])
+    Same as process_image, but the photo and its green mask are kept at
+    full resolution in an ImagePyramid (see pyramid.py) instead of being
+    rendered into the annotated image.
 
-    return img, text_data, plot_img2
+    Returns:
+    tuple: Processed image, text data, ImagePyramid and the region dicts.
+    """
+    from pyramid import ImagePyramid
+
+    def build_pyramid(image, mask, isolated_green, regions, workspace):
+        with report.stage('pyramid'):
+            # The mask may live in the workspace, the pyramid keeps its own copy
+            return ImagePyramid(image, mask.copy())
+
+    return _process_image(image_path, conversion_factor, label_mapping, lower_green, upper_green, min_area,
+                          dilation_kernel_size, max_regions, grid_size, num_columns, trays, cache, progress, report,
+                          workspace, build_pyramid)
+
+
+def _process_image(image_path, conversion_factor, label_mapping, lower_green, upper_green, min_area,
+                   dilation_kernel_size, max_regions, grid_size, num_columns, trays, cache, progress, report, workspace,
+                   finish):
+    # Shared by process_image and process_image_pyramid, finish(image, mask, isolated_green, regions, workspace)
+    # returns the third result
+    if progress is None:
+        progress = lambda fraction, message: None
+
+    progress(0.0, "Loading image")
+    with report.stage('decode'):
+        image = load_image(image_path)
+        report.record('image', image)
+
+    regions = masks = None
+    if cache is not None:
+        with report.stage('cache_lookup'):
+            key = cache.make_key(image_path, conversion_factor, label_mapping, lower_green, upper_green, min_area,
+                                 dilation_kernel_size, max_regions, num_columns, trays)
+            regions = cache.get(key)
+            masks = cache.get_masks(key) if regions is not None else None
+
+    # Only the rendered PIL images and the regions leave the workspace
+    with (workspace or Workspace()).borrow() as workspace:
+        progress(0.2, "Segmenting")
+        if masks is not None:
+            mask, dilated_mask = masks
+        else:
+            mask, dilated_mask = segment_image(image, lower_green, upper_green, dilation_kernel_size, report, workspace)
+            regions = measure_regions(image, mask, dilated_mask, conversion_factor, label_mapping, min_area,
+                                      max_regions, num_columns, trays, report, workspace)
+            if cache is not None:
+                with report.stage('cache_store'):
+                    cache.put(key, regions, (mask, dilated_mask))
+
+        progress(0.6, "Rendering")
+        isolated_green = isolate_green(image, mask, report, workspace)
+        img = render_region_grid(isolated_green, regions, grid_size, num_columns, report)
+        progress(0.9, "Annotating")
+        view = finish(image, mask, isolated_green, regions, workspace)
+        progress(1.0, "Done")
+
+    return img, format_regions(regions, find_empty_cells(regions, label_mapping, num_columns, trays)), view, regions
 
 
 
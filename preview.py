@@ -0,0 +1,77 @@
+from PIL import Image
+import cv2
+import numpy as np
+
+from morphology import dilate
+
+
+class PreviewPipeline:
+    """
+    Incremental segmentation of a downscaled proxy for interactive tuning.
+
+    The proxy, its HSV conversion, the mask and the dilated mask are kept in
+    memory. update() only reruns the stages whose inputs changed: a threshold
+    change reruns inRange onward, a kernel change only the dilation.
+    """
+
+    def __init__(self, image, max_size=(800, 600), full_width=None):
+        """
+        Args:
+        image (numpy.ndarray): BGR image, full resolution or already reduced.
+        max_size (tuple): Maximum (width, height) of the proxy.
+        full_width (int): Width of the full resolution image when image is
+            already reduced, used to scale the dilation kernel.
+        """
+        height, width = image.shape[:2]
+        resize = min(1.0, max_size[0] / width, max_size[1] / height)
+        if resize < 1.0:
+            image = cv2.resize(image, (max(1, round(width * resize)), max(1, round(height * resize))),
+                               interpolation=cv2.INTER_AREA)
+        self.scale = image.shape[1] / (full_width or width)
+        self.image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        self.image_hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+        self.mask = None
+        self.dilated_mask = None
+        self._thresholds = None
+        self._kernel_size = None
+
+    def update(self, lower_green, upper_green, dilation_kernel_size):
+        """
+        Bring the masks up to date with the given parameters.
+
+        Args:
+        lower_green (tuple): Lower HSV bound for green color segmentation.
+        upper_green (tuple): Upper HSV bound for green color segmentation.
+        dilation_kernel_size (tuple): Kernel size at full resolution.
+
+        Returns:
+        tuple: Green mask and dilated mask of the proxy.
+        """
+        thresholds = (tuple(lower_green), tuple(upper_green))
+        if thresholds != self._thresholds:
+            self.mask = cv2.inRange(self.image_hsv, thresholds[0], thresholds[1])
+            self._thresholds = thresholds
+            self._kernel_size = None  # The dilation depends on the mask
+
+        # Scale the kernel with the proxy so the merged regions look the same as at full resolution
+        kernel_size = tuple(max(1, round(k * self.scale)) for k in dilation_kernel_size)
+        if kernel_size != self._kernel_size:
+            self.dilated_mask = dilate(self.mask, kernel_size)
+            self._kernel_size = kernel_size
+
+        return self.mask, self.dilated_mask
+
+    def render(self):
+        """
+        Draw the current segmentation over the proxy.
+
+        Returns:
+        PIL.Image: The proxy with non-green pixels dimmed and merged regions outlined.
+        """
+        preview = self.image_rgb // 3
+        np.copyto(preview, self.image_rgb, where=(self.mask > 0)[..., None])
+
+        contours, _ = cv2.findContours(self.dilated_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cv2.drawContours(preview, contours, -1, (255, 0, 0), 1)
+        return Image.fromarray(preview)
@@ -0,0 +1,101 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+class StageReport:
+    """
+    Per-stage timings and array allocations collected from the pipeline.
+
+    Pass one to measure_image or process_image as report=...; every stage
+    runs inside report.stage(name) and the arrays it produces are passed to
+    report.record(). With trace_memory set, the Python/numpy heap growth and
+    peak of each stage are measured with tracemalloc, which slows the run down.
+    """
+
+    enabled = True
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self._current = None
+
+    @contextmanager
+    def stage(self, name):
+        entry = {'name': name, 'seconds': 0.0, 'arrays': []}
+        parent, self._current = self._current, entry
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = time.perf_counter() - start
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                entry['memory_delta'] = current - start_memory
+                entry['memory_peak'] = peak - start_memory
+            self.stages.append(entry)
+            self._current = parent
+
+    def record(self, name, array):
+        """Record an array allocated by the current stage."""
+        if self._current is not None:
+            self._current['arrays'].append({'name': name, 'shape': list(array.shape), 'dtype': str(array.dtype),
+                                            'bytes': int(array.nbytes)})
+
+    @property
+    def total_seconds(self):
+        return sum(entry['seconds'] for entry in self.stages)
+
+    @property
+    def allocated_bytes(self):
+        return sum(array['bytes'] for entry in self.stages for array in entry['arrays'])
+
+    def to_dict(self):
+        return {
+            'total_seconds': self.total_seconds,
+            'allocations': sum(len(entry['arrays']) for entry in self.stages),
+            'allocated_bytes': self.allocated_bytes,
+            'stages': self.stages,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def format(self):
+        """
+        Format the report as the text shown in the Data tab.
+
+        Returns:
+        str: One line per stage with its time, allocations and their size.
+        """
+        lines = ['Stage timings:']
+        for entry in self.stages:
+            size = sum(array['bytes'] for array in entry['arrays']) / 1024 ** 2
+            line = f"{entry['name']:<18} {entry['seconds'] * 1000:8.1f} ms  {len(entry['arrays'])} arrays  {size:.1f} MB"
+            if 'memory_peak' in entry:
+                line += f"  peak {entry['memory_peak'] / 1024 ** 2:.1f} MB"
+            lines.append(line)
+        lines.append(f"{'total':<18} {self.total_seconds * 1000:8.1f} ms  {self.allocated_bytes / 1024 ** 2:.1f} MB")
+        return '\n'.join(lines)
+
+
+class _NullReport:
+    """Stand-in used when profiling is off, every hook is a no-op."""
+
+    enabled = False
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def record(self, name, array):
+        pass
+
+
+NULL_REPORT = _NullReport()
@@ -0,0 +1,87 @@
+import math
+
+import cv2
+import numpy as np
+
+# Levels are halved until they fit in this many pixels
+MIN_LEVEL_SIZE = 256
+# Brightness kept outside the green mask when the mask layer is shown
+MASK_DIM = 1 / 3
+# Gray shown around the image when panned past its edges
+BACKGROUND = 64
+
+
+class ImagePyramid:
+    """
+    A photo and its green mask at halving resolutions, for zooming and panning.
+
+    The levels are built once per result. A view only ever samples the
+    visible part of the level closest to the zoom, so drawing a frame costs
+    the same for a 2 MP and a 50 MP image. The full resolution photo is
+    kept by reference, not copied.
+    """
+
+    def __init__(self, image, mask=None):
+        """
+        Args:
+        image (numpy.ndarray): Full resolution BGR image, must not be modified afterwards.
+        mask (numpy.ndarray): Green mask (0/255) of the same size, None for no mask layer.
+        """
+        self.levels = [image]
+        self.mask_levels = [mask]
+        while max(self.levels[-1].shape[:2]) > MIN_LEVEL_SIZE:
+            height, width = self.levels[-1].shape[:2]
+            size = (max(1, width // 2), max(1, height // 2))
+            self.levels.append(cv2.resize(self.levels[-1], size, interpolation=cv2.INTER_AREA))
+            # Averaged mask pixels keep the coverage of the edges, they blend smoothly when zoomed out
+            self.mask_levels.append(cv2.resize(self.mask_levels[-1], size, interpolation=cv2.INTER_AREA)
+                                    if mask is not None else None)
+
+    @property
+    def size(self):
+        """(width, height) of the full resolution image."""
+        return self.levels[0].shape[1], self.levels[0].shape[0]
+
+    @property
+    def has_mask(self):
+        return self.mask_levels[0] is not None
+
+    def level_for(self, zoom):
+        """Index of the smallest level that still has at least zoom pixels per image pixel."""
+        if zoom >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / zoom))), len(self.levels) - 1)
+
+    def render(self, origin, zoom, out_size, show_mask=False):
+        """
+        Render the visible part of the image.
+
+        Args:
+        origin (tuple): Full resolution (x, y) shown at the top left corner of the view.
+        zoom (float): View pixels per full resolution pixel.
+        out_size (tuple): (width, height) of the view.
+        show_mask (bool): Dim the pixels outside the green mask.
+
+        Returns:
+        numpy.ndarray: RGB view of out_size.
+        """
+        level = self.level_for(zoom)
+        image = self.levels[level]
+        scale = image.shape[1] / self.size[0]
+        # View pixel (u, v) samples level pixel ((origin + (u, v) / zoom) * scale), only the view is computed
+        step = scale / zoom
+        matrix = np.array([[step, 0, origin[0] * scale + (step - 1) / 2],
+                           [0, step, origin[1] * scale + (step - 1) / 2]])
+        # Nearest pixels when magnified, to see the actual edges the segmentation worked on
+        interpolation = cv2.INTER_NEAREST if zoom > 1 else cv2.INTER_LINEAR
+        flags = interpolation | cv2.WARP_INVERSE_MAP
+        view = cv2.warpAffine(image, matrix, out_size, flags=flags, borderMode=cv2.BORDER_CONSTANT,
+                              borderValue=(BACKGROUND,) * 3)
+
+        if show_mask and self.has_mask:
+            mask = cv2.warpAffine(self.mask_levels[level], matrix, out_size, flags=flags,
+                                  borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+            # Per-pixel brightness from MASK_DIM outside the mask to 1 inside, as 0..255
+            weight = cv2.convertScaleAbs(mask, alpha=1 - MASK_DIM, beta=255 * MASK_DIM)
+            view = cv2.multiply(view, cv2.merge([weight] * 3), scale=1 / 255)
+        return cv2.cvtColor(view, cv2.COLOR_BGR2RGB)
@@ -5,6 +5,8 @@ DATA_FILES = []
 OPTIONS = {
     'argv_emulation': False,
     'packages': ['cv2', 'PIL', 'numpy', 'matplotlib'],
+    # Imported lazily by name (ui_functions.HEAVY_MODULES), invisible to the import scanner: keep both lists in sync
+    'includes': ['image_processing', 'preview', 'pyramid', 'cache', 'PIL.ImageTk'],
     'iconfile': 'icon.icns',  # Path to your .icns file
     'excludes': ['zmq'],
 }
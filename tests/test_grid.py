@@ -0,0 +1,66 @@
+import math
+import unittest
+
+import numpy as np
+
+from grid import fit_grid
+
+PITCH = 100.0
+
+
+def random_tray(rng, num_rows, num_columns, jitter, max_skew=6.0, drop=0.1):
+    """
+    Plant centers of a tray with known cells.
+
+    Every center is moved by normal jitter (as a fraction of the pitch, cut
+    at 0.4 pitch so every plant stays nearest to its own cell), a share of
+    the cells is left empty and the tray is rotated and shifted.
+
+    Returns:
+    tuple: (N, 2) centers as (x, y), (N, 2) sizes and (N, 2) true (row, column) cells.
+    """
+    rows, columns = np.meshgrid(np.arange(num_rows), np.arange(num_columns), indexing='ij')
+    cells = np.stack([rows.ravel(), columns.ravel()], axis=1)
+    cells = cells[rng.random(len(cells)) >= drop]
+    offsets = np.clip(rng.normal(0, jitter, (len(cells), 2)), -0.4, 0.4)
+    points = (cells[:, ::-1] + offsets) * PITCH
+    angle = math.radians(rng.uniform(-max_skew, max_skew))
+    rotation = np.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+    centers = points @ rotation.T + rng.uniform(0, 1000, 2)
+    sizes = rng.uniform(0.4, 0.7, (len(cells), 2)) * PITCH
+    return centers, sizes, cells
+
+
+class FitGridTest(unittest.TestCase):
+
+    def check_layouts(self, num_rows, num_columns, jitter, count=30):
+        rng = np.random.default_rng(num_rows * 1000 + int(jitter * 100))
+        for trial in range(count):
+            centers, sizes, cells = random_tray(rng, num_rows, num_columns, jitter)
+            fit = fit_grid(centers, sizes, num_columns)
+            # Empty first rows or columns cannot be seen, compare from the first occupied ones
+            with self.subTest(trial=trial):
+                np.testing.assert_array_equal(fit['cells'] - fit['cells'].min(axis=0), cells - cells.min(axis=0))
+
+    def test_96_cell_trays(self):
+        for jitter in (0.05, 0.1, 0.12):
+            with self.subTest(jitter=jitter):
+                self.check_layouts(8, 12, jitter)
+
+    def test_384_cell_trays(self):
+        for jitter in (0.05, 0.1, 0.12):
+            with self.subTest(jitter=jitter):
+                self.check_layouts(16, 24, jitter)
+
+    def test_skew_is_found(self):
+        rng = np.random.default_rng(0)
+        centers, sizes, cells = random_tray(rng, 8, 12, 0.0, drop=0.0)
+        x, y = centers[:, 0], centers[:, 1]
+        # Slope of the first row, from its ends
+        first = np.flatnonzero(cells[:, 0] == 0)
+        expected = math.degrees(math.atan2(y[first[-1]] - y[first[0]], x[first[-1]] - x[first[0]]))
+        self.assertAlmostEqual(fit_grid(centers, sizes, 12)['angle'], expected, places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import cv2
+import numpy as np
+
+from image_processing import segment_image
+
+
+def _find(parent, i):
+    # Union-find root lookup with path halving
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def component_stats_tiled(image, lower_green=(35, 52, 72), upper_green=(102, 255, 255), dilation_kernel_size=(50, 50),
+                          tile_height=2048, workspace=None):
+    """
+    Segment and measure an image in horizontal strips, with bounded memory.
+
+    Each strip is read with enough overlap above and below for the dilation
+    of its own rows to be exact, so only one strip's HSV image and masks are
+    alive at a time. Regions cut by a strip boundary are stitched back
+    together (8-connectivity) before their statistics are merged, so the
+    result matches component_stats on the whole image.
+
+    Args:
+    image (numpy.ndarray): BGR image.
+    lower_green (tuple): Lower HSV bound for green color segmentation.
+    upper_green (tuple): Upper HSV bound for green color segmentation.
+    dilation_kernel_size (tuple): Size of the kernel for dilation.
+    tile_height (int): Number of rows measured per strip, excluding the overlap.
+    workspace (Workspace): Optional buffers reused by every strip, see workspace.py.
+
+    Returns:
+    dict: Region arrays, see image_processing.component_stats.
+    """
+    height = image.shape[0]
+    kernel_height = dilation_kernel_size[0]
+    # OpenCV centers the kernel at kernel_height // 2, row y of the dilation depends on these input rows
+    above = kernel_height // 2
+    below = kernel_height - 1 - above
+
+    x0, y0, x1, y1, area, pixel_area, intensity, cx_sum, cy_sum = ([] for _ in range(9))
+    pairs = []
+    offset = 0
+    previous_row = None
+
+    for top in range(0, height, tile_height):
+        bottom = min(top + tile_height, height)
+        read_top = max(0, top - above)
+        read_bottom = min(height, bottom + below)
+
+        mask, dilated_mask = segment_image(image[read_top:read_bottom], lower_green, upper_green, dilation_kernel_size,
+                                           workspace=workspace)
+        mask = mask[top - read_top:bottom - read_top]
+        dilated_mask = dilated_mask[top - read_top:bottom - read_top]
+
+        labels = workspace.array('labels', dilated_mask.shape, np.int32) if workspace else None
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(dilated_mask, labels=labels, connectivity=8)
+        strip = image[top:bottom]
+        green = np.flatnonzero(mask)
+        green_labels = labels.ravel()[green]
+
+        x0.append(stats[1:, cv2.CC_STAT_LEFT])
+        y0.append(stats[1:, cv2.CC_STAT_TOP] + top)
+        x1.append(stats[1:, cv2.CC_STAT_LEFT] + stats[1:, cv2.CC_STAT_WIDTH])
+        y1.append(stats[1:, cv2.CC_STAT_TOP] + stats[1:, cv2.CC_STAT_HEIGHT] + top)
+        area.append(stats[1:, cv2.CC_STAT_AREA])
+        pixel_area.append(np.bincount(green_labels, minlength=n)[1:])
+        intensity.append(np.bincount(green_labels, weights=strip.reshape(-1, 3)[green].sum(axis=1), minlength=n)[1:])
+        # Area-weighted centroid sums merge exactly across strips
+        cx_sum.append(centroids[1:, 0] * stats[1:, cv2.CC_STAT_AREA])
+        cy_sum.append((centroids[1:, 1] + top) * stats[1:, cv2.CC_STAT_AREA])
+
+        # Global ids (0 = background) of the regions touching the strip's first and last rows
+        first_row = np.where(labels[0] > 0, labels[0] + offset, 0)
+        if previous_row is not None:
+            for shift in (-1, 0, 1):
+                a = previous_row[max(0, shift):len(previous_row) + min(0, shift)]
+                b = first_row[max(0, -shift):len(first_row) + min(0, -shift)]
+                touching = (a > 0) & (b > 0)
+                pairs.append(np.stack([a[touching], b[touching]], axis=1))
+        previous_row = np.where(labels[-1] > 0, labels[-1] + offset, 0)
+        offset += n - 1
+
+    x0, y0, x1, y1, area, pixel_area, intensity, cx_sum, cy_sum = (
+        np.concatenate(column) for column in (x0, y0, x1, y1, area, pixel_area, intensity, cx_sum, cy_sum))
+
+    # Merge the regions that continue across strip boundaries
+    parent = list(range(offset + 1))
+    if pairs:
+        for a, b in np.unique(np.concatenate(pairs), axis=0):
+            root_a, root_b = _find(parent, a), _find(parent, b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+    roots = np.array([_find(parent, i) for i in range(1, offset + 1)], dtype=np.int64)
+    unique_roots, index = np.unique(roots, return_inverse=True)
+    count = len(unique_roots)
+
+    merged_x0 = np.full(count, np.iinfo(np.int64).max)
+    merged_y0 = np.full(count, np.iinfo(np.int64).max)
+    np.minimum.at(merged_x0, index, x0)
+    np.minimum.at(merged_y0, index, y0)
+    merged_x1 = np.zeros(count, np.int64)
+    merged_y1 = np.zeros(count, np.int64)
+    np.maximum.at(merged_x1, index, x1)
+    np.maximum.at(merged_y1, index, y1)
+
+    merged_area = np.bincount(index, weights=area, minlength=count)
+    centroid = np.stack([np.bincount(index, weights=cx_sum, minlength=count),
+                         np.bincount(index, weights=cy_sum, minlength=count)], axis=1)
+    centroid /= np.maximum(merged_area, 1)[:, None]
+
+    return {
+        'x': merged_x0,
+        'y': merged_y0,
+        'w': merged_x1 - merged_x0,
+        'h': merged_y1 - merged_y0,
+        'area': merged_area.astype(np.int64),
+        'pixel_area': np.bincount(index, weights=pixel_area, minlength=count).astype(np.int64),
+        'intensity': np.bincount(index, weights=intensity, minlength=count),
+        'centroid': centroid,
+    }
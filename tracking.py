@@ -0,0 +1,405 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from batch import (add_processing_arguments, build_trays, calibrator_from_args, collect_images, params_from_args,
+                   worker_cache, worker_workspace)
+from config import choose_label
+from utils import save_json
+
+# Regions further than this from a plant's last position (as a fraction of the
+# image size) start a new plant instead of being matched to it
+MAX_MATCH_DISTANCE = 0.05
+
+
+class PlantStore:
+    """
+    Append-only columnar store of per-plant areas across sessions.
+
+    Every column is a raw little-endian array in its own file, one row per
+    plant per session. A session appends its rows to the end of each file,
+    nothing is ever rewritten, and reading a season back is one np.fromfile
+    per column. sessions.json lists the sessions with the number of rows
+    committed after each and the labels of the plants each one introduced;
+    it is the commit point, replaced atomically once the rows are written,
+    so rows of an interrupted session are cut off the next time the store is
+    opened. plants.json is the registry of tracked plants (label and last
+    known position) as of the session count saved in it. It is written after
+    sessions.json and brought up to date from the committed rows if a run
+    stopped in between, so it never holds plants or positions of a session
+    that was not committed.
+    """
+
+    COLUMNS = {
+        'session': '<i4',
+        'plant': '<i4',
+        'area': '<f8',
+        'pixel_area': '<i8',
+        'x': '<f4',
+        'y': '<f4',
+    }
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.sessions = self._load_json('sessions.json', [])
+        registry = self._load_json('plants.json', {'sessions': 0, 'plants': []})
+        self.plants = registry['plants']
+
+        # Drop the rows of a session that was interrupted before it was committed
+        num_rows = self.sessions[-1]['rows'] if self.sessions else 0
+        for name, dtype in self.COLUMNS.items():
+            path = self._column_path(name)
+            size = num_rows * np.dtype(dtype).itemsize
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            if os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+        # Sessions committed after the registry was last saved
+        if registry['sessions'] < len(self.sessions):
+            for session in range(registry['sessions'], len(self.sessions)):
+                start = self.sessions[session - 1]['rows'] if session else 0
+                rows = {name: np.fromfile(self._column_path(name), dtype=self.COLUMNS[name],
+                                          count=self.sessions[session]['rows'] - start,
+                                          offset=start * np.dtype(self.COLUMNS[name]).itemsize)
+                        for name in ('plant', 'x', 'y')}
+                self._update_plants(session, rows)
+            self._save_plants()
+
+    @property
+    def num_rows(self):
+        return self.sessions[-1]['rows'] if self.sessions else 0
+
+    def find_session(self, name):
+        """Return the index of the session with this name, None if there is none."""
+        for index, session in enumerate(self.sessions):
+            if session['name'] == name:
+                return index
+        return None
+
+    def session_name(self, image_path):
+        """
+        Name of the session of an image: its path relative to the store.
+
+        Daily photos often share a file name in different folders, the
+        relative path tells them apart and still holds when the store is
+        moved together with the images.
+        """
+        try:
+            return os.path.relpath(os.path.abspath(image_path), os.path.abspath(self.directory))
+        except ValueError:
+            # On another drive than the store (Windows)
+            return os.path.abspath(image_path)
+
+    def append_session(self, name, rows, new_plants=(), **info):
+        """
+        Append the measurements of one session and update the plant registry.
+
+        Args:
+        name (str): Session name, see session_name.
+        rows (dict): Column name to sequence of values, one per measured plant.
+        new_plants (list): Labels of the plants first seen in this session, their ids follow the known plants.
+        **info: Extra fields stored with the session (image size, time...).
+
+        Returns:
+        int: Index of the new session.
+        """
+        session = len(self.sessions)
+        num_new = len(rows['plant'])
+        written = {}
+        for column, dtype in self.COLUMNS.items():
+            values = np.full(num_new, session) if column == 'session' else rows[column]
+            written[column] = np.asarray(values, dtype=dtype)
+            with open(self._column_path(column), 'ab') as file:
+                written[column].tofile(file)
+
+        self.sessions.append({'name': name, 'rows': self.num_rows + num_new, 'new_plants': list(new_plants),
+                              **info})
+        self._save_json('sessions.json', self.sessions)
+        # From the stored values, the same a reopened store would recover
+        self._update_plants(session, written)
+        self._save_plants()
+        return session
+
+    def _update_plants(self, session, rows):
+        """Add the plants introduced by a committed session and move the plants to their positions in it."""
+        for label in self.sessions[session].get('new_plants', []):
+            self.plants.append({'id': len(self.plants), 'label': label, 'first_session': session})
+        for plant_id, x, y in zip(rows['plant'], rows['x'], rows['y']):
+            # Follow slow drift of the plants (and of the camera) from session to session
+            self.plants[plant_id]['position'] = [float(x), float(y)]
+            self.plants[plant_id]['last_session'] = session
+
+    def _save_plants(self):
+        self._save_json('plants.json', {'sessions': len(self.sessions), 'plants': self.plants})
+
+    def column(self, name):
+        """Read a whole column (all committed sessions)."""
+        return np.fromfile(self._column_path(name), dtype=self.COLUMNS[name], count=self.num_rows)
+
+    def history(self, plant):
+        """
+        Area history of one plant.
+
+        Args:
+        plant (int): Plant id, an index into plants.
+
+        Returns:
+        dict: Arrays 'session', 'area', 'pixel_area', 'x' and 'y' of the sessions the plant was measured in.
+        """
+        selected = self.column('plant') == plant
+        return {name: self.column(name)[selected] for name in self.COLUMNS if name != 'plant'}
+
+    def find_plant(self, label):
+        """Return the id of the plant with this label, None if it is unknown."""
+        for plant in self.plants:
+            if plant['label'] == label:
+                return plant['id']
+        return None
+
+    def _column_path(self, name):
+        return os.path.join(self.directory, f'{name}.bin')
+
+    def _load_json(self, name, default):
+        try:
+            with open(os.path.join(self.directory, name)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return default
+
+    def _save_json(self, name, data):
+        save_json(os.path.join(self.directory, name), data, indent=1)
+
+
+def match_regions(positions, plants, max_distance=MAX_MATCH_DISTANCE):
+    """
+    Greedily match the regions of a new session to the known plants.
+
+    All region/plant pairs closer than max_distance are visited from the
+    closest up, each region and plant is used at most once.
+
+    Args:
+    positions (numpy.ndarray): (N, 2) region positions, normalized to the image size.
+    plants (list): Plant records with their last 'position'.
+    max_distance (float): Largest distance at which a region continues a plant.
+
+    Returns:
+    list: The matched plant id of every region, None for new plants.
+    """
+    matches = [None] * len(positions)
+    if len(positions) == 0 or not plants:
+        return matches
+
+    known = np.array([plant['position'] for plant in plants], dtype=float)
+    distances = np.linalg.norm(positions[:, None, :] - known[None, :, :], axis=2)
+
+    used = set()
+    for flat in np.argsort(distances, axis=None, kind='stable'):
+        region, plant = divmod(int(flat), len(plants))
+        if distances[region, plant] > max_distance:
+            break
+        if matches[region] is None and plant not in used:
+            matches[region] = plants[plant]['id']
+            used.add(plant)
+    return matches
+
+
+def track_session(store, name, regions, image_size, max_distance=MAX_MATCH_DISTANCE, **info):
+    """
+    Match the regions of one image to the tracked plants and store their areas.
+
+    Matched plants keep their label whatever label the region got from the
+    sort order of this image. Unmatched regions become new plants, labeled
+    with their region label (suffixed with the plant id if already taken).
+    The registry only changes once the session is committed to the store.
+
+    Args:
+    store (PlantStore): Store to append to.
+    name (str): Session name.
+    regions (list): Region dicts from measure_image.
+    image_size (tuple): (width, height) of the image.
+    max_distance (float): See match_regions.
+    **info: Extra session fields.
+
+    Returns:
+    list: (plant label, area) of every region, in region order.
+    """
+    width, height = image_size
+    positions = np.array([(region['centroid'][0] / width, region['centroid'][1] / height) for region in regions],
+                         dtype=float).reshape(-1, 2)
+    matches = match_regions(positions, store.plants, max_distance)
+
+    labels = {plant['label'] for plant in store.plants}
+    plant_ids = []
+    new_plants = []
+    for region, plant_id in zip(regions, matches):
+        if plant_id is None:
+            plant_id = len(store.plants) + len(new_plants)
+            label = region['label'] if region['label'] not in labels else f"{region['label']}-{plant_id}"
+            labels.add(label)
+            new_plants.append(label)
+        plant_ids.append(plant_id)
+
+    store.append_session(name, {
+        'plant': plant_ids,
+        'area': [region['area'] for region in regions],
+        'pixel_area': [region['pixel_area'] for region in regions],
+        'x': positions[:, 0],
+        'y': positions[:, 1],
+    }, new_plants, width=width, height=height, **info)
+    return [(store.plants[plant_id]['label'], region['area']) for plant_id, region in zip(plant_ids, regions)]
+
+
+def measure_one(image_path, conversion_factor, label_preset, params, cache_dir=None):
+    """
+    Measure one image in a worker process.
+
+    A conversion_factor of None calibrates the image from its own reference marker.
+
+    Returns:
+    tuple: Image path, region dicts, (width, height) and an error message (None on success).
+    """
+    import image_processing
+    from calibration import per_image_factor
+
+    try:
+        source = image_processing.ImageSource(image_path)
+        if conversion_factor is None:
+            conversion_factor = per_image_factor(source, params['marker_size'])
+        regions = image_processing.measure_image(
+            source, conversion_factor, choose_label(label_preset), params['lower_green'], params['upper_green'],
+            params['min_area'], params['dilation_kernel_size'], params['max_regions'], params['num_columns'],
+            build_trays(params['trays']), cache=worker_cache(cache_dir),
+            tile_height=params['tile_height'], workspace=worker_workspace())
+        return image_path, regions, source.size, None
+    except Exception as e:
+        return image_path, [], None, f'{type(e).__name__}: {str(e).strip()}'
+
+
+def add_images(store, image_paths, conversion_factor, label_preset, params, workers=None, cache_dir=None,
+               max_distance=MAX_MATCH_DISTANCE, calibrator=None):
+    """
+    Add the images not yet in the store as new sessions, in the order given.
+
+    Images are measured in parallel but matched one after the other, each
+    session against the plant positions left by the previous one. Images
+    already in the store (see PlantStore.session_name) are reported and
+    skipped. With a calibrator, the conversion factor comes from the
+    reference marker instead (see calibration.Calibrator).
+
+    Returns:
+    int: Number of images that failed.
+    """
+    new_paths = []
+    for path in image_paths:
+        session = store.find_session(store.session_name(path))
+        if session is not None:
+            print(f'{path}: already in the store as session {session}, skipped', file=sys.stderr)
+        else:
+            new_paths.append(path)
+    image_paths = new_paths
+    failures = 0
+    n = len(image_paths)
+    factors = calibrator.rig_factors(image_paths) if calibrator else [conversion_factor] * n
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(measure_one, image_paths, factors, [label_preset] * n, [params] * n,
+                               [cache_dir] * n)
+        for idx, (image_path, regions, image_size, error) in enumerate(results, start=1):
+            name = store.session_name(image_path)
+            if error:
+                failures += 1
+                print(f'[{idx}/{n}] {image_path} FAILED: {error}', file=sys.stderr)
+                continue
+            modified = datetime.fromtimestamp(os.path.getmtime(image_path)).isoformat(timespec='seconds')
+            rows = track_session(store, name, regions, image_size, max_distance, modified=modified)
+            new = sum(1 for plant in store.plants if plant['first_session'] == len(store.sessions) - 1)
+            print(f'[{idx}/{n}] {image_path}: {len(rows)} regions, {new} new plants', file=sys.stderr)
+    return failures
+
+
+def export_history(store, output, labels=None):
+    """
+    Write the area history of the tracked plants as a long table.
+
+    Args:
+    store (PlantStore): Store to read.
+    output (file): Open text file.
+    labels (list): Only export these plants, all of them if None.
+    """
+    session = store.column('session')
+    plant = store.column('plant')
+    area = store.column('area')
+
+    selected = np.ones(len(plant), dtype=bool)
+    if labels:
+        ids = [store.find_plant(label) for label in labels]
+        unknown = [label for label, plant_id in zip(labels, ids) if plant_id is None]
+        if unknown:
+            raise ValueError(f"Unknown plants: {', '.join(unknown)}")
+        selected = np.isin(plant, ids)
+
+    # One plant after the other, in session order
+    rows = np.flatnonzero(selected)
+    rows = rows[np.lexsort((session[rows], plant[rows]))]
+
+    writer = csv.writer(output)
+    writer.writerow(['label', 'session', 'image', 'modified', 'area_cm2'])
+    for i in rows:
+        info = store.sessions[session[i]]
+        writer.writerow([store.plants[plant[i]]['label'], int(session[i]), info['name'], info.get('modified', ''),
+                         float(area[i])])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Track the leaf area of the same plants across sessions.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add = subparsers.add_parser('add', help='Measure new images and add them as sessions.')
+    add.add_argument('inputs', nargs='+', help='Image files, directories or glob patterns, one session each.')
+    add.add_argument('--store', required=True, help='Tracking store directory.')
+    add.add_argument('--max-distance', type=float, default=MAX_MATCH_DISTANCE,
+                     help='Largest move of a plant between sessions, as a fraction of the image size.')
+    add_processing_arguments(add)
+
+    export = subparsers.add_parser('export', help='Write the area history of the tracked plants as CSV.')
+    export.add_argument('--store', required=True, help='Tracking store directory.')
+    export.add_argument('labels', nargs='*', help='Plants to export, all by default.')
+    export.add_argument('-o', '--output', default=None, help='Output CSV file, stdout by default.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = PlantStore(args.store)
+
+    if args.command == 'add':
+        image_paths = collect_images(args.inputs)
+        if not image_paths:
+            print('No images found.', file=sys.stderr)
+            return 1
+        failures = add_images(store, image_paths, args.conversion_factor, args.preset, params_from_args(args),
+                              args.workers, args.cache_dir, args.max_distance, calibrator_from_args(args))
+        print(f'{len(store.sessions)} sessions, {len(store.plants)} plants tracked.', file=sys.stderr)
+        return 1 if failures else 0
+
+    unknown = [label for label in args.labels if store.find_plant(label) is None]
+    if unknown:
+        print(f"Unknown plants: {', '.join(unknown)}", file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, 'w', newline='') as file:
+            export_history(store, file, args.labels)
+    else:
+        export_history(store, sys.stdout, args.labels)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,83 @@
 import tkinter as tk
 from tkinter import ttk
-from image_processing import process_image, resize_image_aspect_ratio
 from tkinter import filedialog
-from PIL import Image, ImageTk
 from tkinter import simpledialog, messagebox    
 import logging
-from utils import compute_conversion_factor, export_to_csv
-from config import choose_label
+import os
+import threading
+from utils import compute_conversion_factor, export_records
+from config import choose_label, CACHE_DIR, CACHE_MAX_BYTES, MAX_WINDOW_SIZE
+from worker import BackgroundProcessor
+from profiling import StageReport, NULL_REPORT
+from viewer import ResultViewer
+
+# The image stack (cv2, numpy, PIL and the modules built on them) is imported
+# inside the functions that use it, so the window shows before it has loaded.
+# preload_modules() starts importing it in the background once the window is up.
+# These modules are listed in the py2app includes of setup.py as well.
+HEAVY_MODULES = ('image_processing', 'preview', 'pyramid', 'cache', 'PIL.ImageTk')
 
 # Global variables for slider values
 global lower_green_sliders, upper_green_sliders, min_area_slider, dilation_kernel_size_slider, max_regions_slider, grid_size_slider, num_columns_slider
 
+# The uploaded image, decoded once and shared by calibration, preview and processing
+original_img_source = None
+
+# Scale of the current image (cm/pixel), from the drawn segment or the reference marker
+conversion_factor = None
+# Set when conversion_factor came from the marker, so the next image is calibrated again
+auto_calibrated = False
+# Side of the reference marker (cm), asked for on the first automatic calibration
+marker_size = None
+
+# Live preview state: the pipeline for the current image, its window and the pending debounce timer
+preview_pipeline = None
+preview_window = None
+preview_after_id = None
+PREVIEW_DELAY_MS = 150
+
+# Export records of the last processed image, see export.region_records
+last_records = []
+
+# Runs process_image_pyramid off the Tk main loop, created in setup_ui
+processor = None
+
+# Result cache shared by every processing run, created on first use
+result_cache = None
+
+# Pipeline buffers reused from one processing run to the next, created on first use
+workspace = None
+
+def get_result_cache():
+    global result_cache
+    if result_cache is None:
+        from cache import ResultCache
+
+        result_cache = ResultCache(CACHE_DIR, CACHE_MAX_BYTES, store_masks=True)
+    return result_cache
+
+def get_workspace():
+    global workspace
+    if workspace is None:
+        from workspace import Workspace
+
+        workspace = Workspace()
+    return workspace
+
+def preload_modules():
+    # Python's import lock makes a function-level import wait for this thread if it is still running
+    def load():
+        import importlib
+        for name in HEAVY_MODULES:
+            importlib.import_module(name)
+        logging.debug('Background imports done')
+
+    threading.Thread(target=load, daemon=True).start()
+
 # Function to create a labeled slider with a default value
 def create_slider(parent, label, from_, to, default, row, column, command=None):
     tk.Label(parent, text=label).grid(row=row, column=column)
-    slider = tk.Scale(parent, from_=from_, to=to, orient=tk.HORIZONTAL, command=lambda value: command())
+    slider = tk.Scale(parent, from_=from_, to=to, orient=tk.HORIZONTAL, command=lambda value: command() if command else None)
     slider.set(default)  # Set the default value
     slider.grid(row=row, column=column + 1)
     return slider
@@ -23,11 +86,13 @@ def update_color_preview(sliders, preview_label):
     r, g, b = [slider.get() for slider in sliders]
     preview_label.config(bg=f'#{r:02x}{g:02x}{b:02x}')
 
-def create_color_sliders(parent, label, default_values, row):
+def create_color_sliders(parent, label, default_values, row, command=None):
     tk.Label(parent, text=label).grid(row=row, column=0)
 
     def slider_update_command():
         update_color_preview(color_sliders, color_preview)
+        if command:
+            command()
 
     r_slider = create_slider(parent, "R", 0, 255, default_values[0], row, 1, command=slider_update_command)
     g_slider = create_slider(parent, "G", 0, 255, default_values[1], row + 1, 1, command=slider_update_command)
@@ -42,8 +107,8 @@ def create_color_sliders(parent, label, default_values, row):
 
 
 def setup_ui(root):
-    logging.debug('This message will be logged.')
     logging.basicConfig(filename='app.log', level=logging.DEBUG, format='%(asctime)s %(levelname)s:%(message)s')
+    logging.debug('This message will be logged.')
 
     # Declare sliders as global
     global lower_green_sliders, upper_green_sliders, min_area_slider, dilation_kernel_size_slider, max_regions_slider, grid_size_slider, num_columns_slider
@@ -53,8 +118,7 @@ def setup_ui(root):
     root.geometry("1200x800")  # Set default size
 
     # Initialize global variables
-    original_img_path = None
-    global label_preset_var
+    global label_preset_var, live_preview_var, profile_var
     label_preset_var = tk.IntVar(value=1)  # Default to preset 1
 
     # New frame for sliders and color selectors
@@ -86,14 +150,26 @@ def setup_ui(root):
 
     # Upload buttons
     upload_btn = tk.Button(button_frame, text="Upload Image", command=lambda: upload_and_draw_image(root))
-    process_btn = tk.Button(button_frame, text="Process and Display Image", command=lambda: process_and_display_image(left_image_label, text_display, root, label_mapping, conversion_factor))
+    process_btn = tk.Button(button_frame, text="Process and Display Image", command=lambda: process_and_display_image(result_viewer, text_display, root, label_mapping))
 
     upload_btn.pack(side=tk.LEFT, padx=5)
     process_btn.pack(side=tk.LEFT, padx=5)
 
-    # Image label for left_frame (Original Image)
-    left_image_label = tk.Label(left_frame)
-    left_image_label.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+    # Progress of the background processing job
+    global processor, progress_bar, status_label, cancel_btn
+    processor = BackgroundProcessor(root)
+    status_frame = tk.Frame(left_frame)
+    status_frame.pack(padx=10, anchor='nw', fill=tk.X)
+    progress_bar = ttk.Progressbar(status_frame, orient=tk.HORIZONTAL, length=200, mode='determinate', maximum=1.0)
+    progress_bar.pack(side=tk.LEFT)
+    status_label = tk.Label(status_frame, text="")
+    status_label.pack(side=tk.LEFT, padx=5)
+    cancel_btn = tk.Button(status_frame, text="Cancel", state=tk.DISABLED, command=cancel_processing)
+    cancel_btn.pack(side=tk.LEFT, padx=5)
+
+    # Zoomable view of the processed image in left_frame, with the mask and the region boxes as layers
+    result_viewer = ResultViewer(left_frame)
+    result_viewer.frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
     right_image_label = tk.Label(right_frame)
     right_image_label.pack(fill=tk.BOTH, expand=True)
@@ -107,44 +183,113 @@ def setup_ui(root):
     text_display.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
     # Export button
-    export_button = tk.Button(button_frame, text="Export to CSV", command=lambda: export_to_csv(text_display.get('1.0', tk.END)))
+    export_button = tk.Button(button_frame, text="Export", command=lambda: export_records(last_records))
     export_button.pack(side=tk.LEFT, padx=5)
 
+    # Live preview of the segmentation while the sliders move
+    live_preview_var = tk.BooleanVar(value=False)
+    tk.Checkbutton(button_frame, text="Live Preview", variable=live_preview_var,
+                   command=lambda: toggle_live_preview(root)).pack(side=tk.LEFT, padx=5)
+    schedule = lambda: schedule_preview(root)
+
+    # Append per-stage timings of each run to the Data tab
+    profile_var = tk.BooleanVar(value=False)
+    tk.Checkbutton(button_frame, text="Profile", variable=profile_var).pack(side=tk.LEFT, padx=5)
+
 
     # lower_green and upper_green color selectors with default values
-    lower_green_sliders = create_color_sliders(settings_frame, "Lower Green", (35, 52, 72), 0)
-    upper_green_sliders = create_color_sliders(settings_frame, "Upper Green", (102, 255, 255), 3)
+    lower_green_sliders = create_color_sliders(settings_frame, "Lower Green", (35, 52, 72), 0, command=schedule)
+    upper_green_sliders = create_color_sliders(settings_frame, "Upper Green", (102, 255, 255), 3, command=schedule)
 
     # Sliders for other parameters with default values
     min_area_slider = create_slider(settings_frame, "Min Area", 0, 5000, 1000, 6, 0)
     # Dilation kernel size slider
-    dilation_kernel_size_slider = create_slider(settings_frame, "Dilation Kernel Size", 1, 100, 50, 7, 0)
-    max_regions_slider = create_slider(settings_frame, "Max Regions", 1, 50, 24, 9, 0)
+    dilation_kernel_size_slider = create_slider(settings_frame, "Dilation Kernel Size", 1, 100, 50, 7, 0, command=schedule)
+    max_regions_slider = create_slider(settings_frame, "Max Regions", 1, 400, 24, 9, 0)
     grid_size_slider = create_slider(settings_frame, "Grid Size", 1, 20, 6, 10, 0)
     num_columns_slider = create_slider(settings_frame, "Number of Columns", 1, 10, 4, 11, 0)
 
 
-
-    root.mainloop()
+def toggle_live_preview(root):
+    if live_preview_var.get():
+        schedule_preview(root)
+    elif preview_window is not None:
+        preview_window.destroy()
+
+def schedule_preview(root):
+    # Debounce: restart the timer on every slider move, only the last position gets rendered
+    global preview_after_id
+    if not live_preview_var.get() or not original_img_source:
+        return
+    if preview_after_id is not None:
+        root.after_cancel(preview_after_id)
+    preview_after_id = root.after(PREVIEW_DELAY_MS, lambda: update_live_preview(root))
+
+def update_live_preview(root):
+    global preview_pipeline, preview_window, preview_after_id
+    preview_after_id = None
+
+    if preview_pipeline is None:
+        try:
+            image = original_img_source.proxy(MAX_WINDOW_SIZE)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Live Preview", str(e))
+            live_preview_var.set(False)
+            return
+        from preview import PreviewPipeline
+        preview_pipeline = PreviewPipeline(image, MAX_WINDOW_SIZE, full_width=original_img_source.size[0])
+
+    lower_green = tuple(slider.get() for slider in lower_green_sliders)
+    upper_green = tuple(slider.get() for slider in upper_green_sliders)
+    dilation_kernel_size = (dilation_kernel_size_slider.get(), dilation_kernel_size_slider.get())
+    preview_pipeline.update(lower_green, upper_green, dilation_kernel_size)
+
+    if preview_window is None:
+        preview_window = tk.Toplevel(root)
+        preview_window.title("Live Preview")
+        preview_window.image_label = tk.Label(preview_window)
+        preview_window.image_label.pack()
+        preview_window.bind("<Destroy>", lambda event: close_live_preview(event))
+
+    from PIL import ImageTk
+    img = ImageTk.PhotoImage(preview_pipeline.render())
+    preview_window.image_label.config(image=img)
+    preview_window.image_label.image = img  # Keep a reference
+
+def close_live_preview(event):
+    global preview_window
+    if event.widget is preview_window:
+        preview_window = None
+        live_preview_var.set(False)
 
 def upload_and_draw_image(root):
-    global original_img_path, canvas, points, scaling_factor
+    global original_img_source, canvas, points, scaling_factor, preview_pipeline, conversion_factor
     file_path = filedialog.askopenfilename()
     if file_path:
-        original_img_path = file_path
-        original_img = Image.open(file_path)
-
-        # Set maximum size for the drawing window
-        max_window_size = (800, 600)  # width, height
-
-        # Calculate the scaling factor
-        scaling_factor = min(max_window_size[0] / original_img.width, max_window_size[1] / original_img.height)
-
-        # Resize the image to fit the window if it's too large
-        if original_img.width > max_window_size[0] or original_img.height > max_window_size[1]:
-            original_img.thumbnail(max_window_size)
-
-        img = ImageTk.PhotoImage(original_img)
+        import cv2
+        from PIL import Image, ImageTk
+        from image_processing import ImageSource
+
+        original_img_source = ImageSource(file_path)
+        if processor.busy:
+            # The job in flight (and the marker it may be calibrating from) belongs to the previous image
+            cancel_processing()
+        if auto_calibrated:
+            conversion_factor = None  # Found again from the marker or the rig of the new image
+        preview_pipeline = None  # Rebuilt from the new image on the next preview
+        schedule_preview(root)
+
+        # Reduced resolution decode that fits the drawing window
+        try:
+            proxy = original_img_source.proxy(MAX_WINDOW_SIZE)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Upload Image", str(e))
+            return
+
+        # Calculate the scaling factor between the displayed and the original image
+        scaling_factor = proxy.shape[1] / original_img_source.size[0]
+
+        img = ImageTk.PhotoImage(Image.fromarray(cv2.cvtColor(proxy, cv2.COLOR_BGR2RGB)))
 
         # Create a new window for drawing
         draw_window = tk.Toplevel(root)
@@ -175,7 +320,7 @@ def get_point(event,root):
         draw_segment_and_ask_distance(root)
 
 def draw_segment_and_ask_distance(root):
-    global points, canvas, scaling_factor, conversion_factor
+    global points, canvas, scaling_factor, conversion_factor, auto_calibrated
     # Adjust points to original image scale
     adjusted_points = [(x / scaling_factor, y / scaling_factor) for x, y in points]
 
@@ -190,8 +335,46 @@ def draw_segment_and_ask_distance(root):
 
     if distance:
         conversion_factor = compute_conversion_factor(distance, pixel_distance)
-
-def process_and_display_image(left_image_label, text_display, root, label_mapping, conversion_factor):
+        auto_calibrated = False
+
+def ask_marker_size(root):
+    # Side of the reference marker, asked once; None when the user prefers to draw a segment
+    global marker_size
+    if marker_size is None:
+        marker_size = simpledialog.askfloat(
+            "Scale Calibration", "The image is not calibrated.\n"
+            "Enter the side of the square reference marker (cm) to detect it,\n"
+            "or cancel and draw a segment of known length on the image.", parent=root, minvalue=0.0)
+        if not marker_size:
+            marker_size = None
+    return marker_size
+
+def calibrate_and_process(image_source, marker_size, *args, progress, **kwargs):
+    # Runs on the worker thread: the marker search decodes the full resolution image
+    from calibration import Calibrator
+    from image_processing import process_image_pyramid
+
+    progress(0.0, "Detecting the reference marker")
+    # Scale from the reference marker of the image, or the saved calibration of its camera rig
+    factor = Calibrator(marker_size).conversion_factor(image_source)
+    if factor is None:
+        return None, None
+    return factor, process_image_pyramid(image_source, factor, *args, progress=progress, **kwargs)
+
+def marker_calibrated(factor, result, display):
+    global conversion_factor, auto_calibrated
+    if factor is None:
+        finish_progress("Not calibrated")
+        messagebox.showwarning("Scale Calibration",
+                               f"No {marker_size:g} cm reference marker found.\n"
+                               "Draw a segment of known length on the image to calibrate.")
+        return
+    conversion_factor = factor
+    auto_calibrated = True
+    display(result, factor)
+    status_label.config(text=f"Calibrated from marker: {factor:.5f} cm/pixel")
+
+def process_and_display_image(result_viewer, text_display, root, label_mapping):
     global lower_green_sliders, upper_green_sliders, min_area_slider, dilation_kernel_size_slider, max_regions_slider, grid_size_slider, num_columns_slider
     
     # Retrieve values from sliders
@@ -203,44 +386,96 @@ def process_and_display_image(left_image_label, text_display, root, label_mappin
     grid_size = grid_size_slider.get()
     num_columns = num_columns_slider.get()
 
-    if original_img_path:
-        # Process the image
-        processed_img, text_data, verification_plot = process_image(original_img_path, conversion_factor, label_mapping, lower_green, upper_green, min_area, dilation_kernel_size, max_regions, grid_size, num_columns)
-
-        # Set maximum size for the display window
-        max_display_size = (800, 600)  # width, height
-        max_display_size2 = (1000, 700)  # width, height
-
-        # Resize the processed image to fit the window if it's too large
-        processed_img = resize_image_aspect_ratio(processed_img, max_display_size2)
-
-        # Convert the processed image for Tkinter
-        img = ImageTk.PhotoImage(processed_img)
-
-        # Create the new window
-        new_window = tk.Toplevel(root)
-        new_window.title("Processed Image")
-
-        # Set the size of the new window to match the image size
-        new_window.geometry(f'{img.width()}x{img.height()}')
-
-        # Display processed image in the new window
-        processed_img_label = tk.Label(new_window, image=img)
-        processed_img_label.pack()
-
-        # Keep a reference to the image to prevent garbage collection
-        processed_img_label.image = img
-
-        # Resize the verification plot to fit the window if it's too large
-        verification_plot = resize_image_aspect_ratio(verification_plot, max_display_size)
-
-        # Convert the verification plot for Tkinter
-        verification_plot_tk = ImageTk.PhotoImage(verification_plot)
-
-        # Display plot image in the left frame
-        left_image_label.config(image=verification_plot_tk)
-        left_image_label.image = verification_plot_tk  # Keep a reference
-
-        # Display text data in a tab in the right frame of the main window
-        text_display.delete('1.0', tk.END)  # Clear previous text
-        text_display.insert(tk.END, text_data)
\ No newline at end of file
+    if original_img_source:
+        if conversion_factor is None and ask_marker_size(root) is None:
+            return
+
+        # Process the image in the background, a new click supersedes the job in flight
+        from image_processing import process_image_pyramid
+
+        report = StageReport() if profile_var.get() else NULL_REPORT
+        params = {'lower_green': lower_green, 'upper_green': upper_green, 'min_area': min_area,
+                  'dilation_kernel_size': dilation_kernel_size, 'max_regions': max_regions, 'num_columns': num_columns}
+        args = (label_mapping, lower_green, upper_green, min_area, dilation_kernel_size, max_regions, grid_size, num_columns)
+        kwargs = {'cache': get_result_cache(), 'report': report, 'workspace': get_workspace()}
+        display = lambda result, factor: display_processed_image(result, result_viewer, text_display, root, report,
+                                                                 (label_mapping, factor, params))
+        if conversion_factor is None:
+            # Not calibrated yet: the marker is detected by the same background job, before processing
+            processor.submit(calibrate_and_process, (original_img_source, marker_size) + args, kwargs,
+                             on_done=lambda result: marker_calibrated(*result, display),
+                             on_error=processing_failed,
+                             on_progress=update_progress)
+        else:
+            processor.submit(process_image_pyramid, (original_img_source, conversion_factor) + args, kwargs,
+                             on_done=lambda result, factor=conversion_factor: display(result, factor),
+                             on_error=processing_failed,
+                             on_progress=update_progress)
+        update_progress(0.0, "Starting")
+        cancel_btn.config(state=tk.NORMAL)
+
+def update_progress(fraction, message):
+    progress_bar['value'] = fraction
+    status_label.config(text=message)
+
+def finish_progress(message):
+    progress_bar['value'] = 0
+    status_label.config(text=message)
+    cancel_btn.config(state=tk.DISABLED)
+
+def cancel_processing():
+    processor.cancel()
+    finish_progress("Cancelled")
+
+def processing_failed(error):
+    finish_progress("Failed")
+    logging.error("Processing failed", exc_info=error)
+    messagebox.showerror("Processing failed", str(error))
+
+def display_processed_image(result, result_viewer, text_display, root, report=NULL_REPORT, settings=None):
+    global last_records
+    from PIL import ImageTk
+    from export import region_records
+    from image_processing import find_empty_cells, resize_image_aspect_ratio
+
+    processed_img, text_data, pyramid, regions = result
+    finish_progress("Done")
+
+    # Keep the structured records of this run for the Export button
+    if settings:
+        label_mapping, conversion_factor, params = settings
+        empty = find_empty_cells(regions, label_mapping, params['num_columns'])
+        last_records = list(region_records(os.path.basename(original_img_source.path), regions, conversion_factor,
+                                           params, empty))
+
+    # Set maximum size for the display window
+    max_display_size2 = (1000, 700)  # width, height
+
+    # Resize the processed image to fit the window if it's too large
+    processed_img = resize_image_aspect_ratio(processed_img, max_display_size2)
+
+    # Convert the processed image for Tkinter
+    img = ImageTk.PhotoImage(processed_img)
+
+    # Create the new window
+    new_window = tk.Toplevel(root)
+    new_window.title("Processed Image")
+
+    # Set the size of the new window to match the image size
+    new_window.geometry(f'{img.width()}x{img.height()}')
+
+    # Display processed image in the new window
+    processed_img_label = tk.Label(new_window, image=img)
+    processed_img_label.pack()
+
+    # Keep a reference to the image to prevent garbage collection
+    processed_img_label.image = img
+
+    # Show the full resolution result in the zoomable viewer of the left frame
+    result_viewer.show(pyramid, regions)
+
+    # Display text data in a tab in the right frame of the main window
+    text_display.delete('1.0', tk.END)  # Clear previous text
+    text_display.insert(tk.END, text_data)
+    if report.enabled:
+        text_display.insert(tk.END, '\n\n' + report.format())
@@ -1,5 +1,6 @@
-import csv
-from tkinter import filedialog
+import json
+import os
+import tempfile
 
 # Utility functions
 def compute_conversion_factor(real_distance, pixel_distance):
@@ -10,11 +11,42 @@ def compute_conversion_factor(real_distance, pixel_distance):
     print("Conversion Factor:", conversion_factor)
     return conversion_factor
 
-def export_to_csv(text_data):
-    # Export the text data to a CSV file
-    file_path = filedialog.asksaveasfilename(defaultextension='.csv')
+def export_records(records):
+    # Export the measurement records of the last processed image, the format follows the extension
+    from tkinter import filedialog, messagebox
+    from export import RecordWriter
+
+    if not records:
+        messagebox.showinfo("Export", "Process an image first.")
+        return
+    file_path = filedialog.asksaveasfilename(defaultextension='.csv',
+                                             filetypes=[('CSV', '*.csv'), ('JSON Lines', '*.jsonl'),
+                                                        ('Parquet', '*.parquet')])
     if file_path:
-        with open(file_path, 'w', newline='') as file:
-            writer = csv.writer(file)
-            for line in text_data.split('\n'):
-                writer.writerow([line])
+        try:
+            with RecordWriter(file_path) as writer:
+                writer.write_all(records)
+        except (ImportError, ValueError) as e:
+            messagebox.showerror("Export failed", str(e))
+
+def save_json(path, data, indent=None):
+    """
+    Write data to a JSON file through a temporary file and os.replace.
+
+    A crash never leaves a truncated file, and the temporary file is removed
+    if writing fails. The headless tools use it too, utils must not import
+    tkinter at module level.
+
+    Args:
+    path (str): JSON file to replace.
+    data: JSON serializable data.
+    indent (int): Indentation passed to json.dump.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=indent)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,169 @@
+import tkinter as tk
+
+# Zoom factor of one mouse wheel step, and the largest zoom (view pixels per image pixel)
+ZOOM_STEP = 1.25
+MAX_ZOOM = 16.0
+# Colour of the region boxes and labels, as in render_annotated_image
+BOX_COLOR = '#0000ff'
+
+
+class ResultViewer:
+    """
+    Zoomable, pannable view of a processed image with toggleable layers.
+
+    The photo comes from an ImagePyramid (see pyramid.py) and only the
+    visible part is rendered, at the level closest to the zoom, so panning
+    and zooming stay smooth on very large images. The green mask is blended
+    into the rendered view and the region boxes are canvas items redrawn at
+    the current zoom; both can be switched on and off without processing
+    again. The mouse wheel zooms around the pointer, dragging pans and a
+    double click fits the image to the view.
+    """
+
+    def __init__(self, parent, size=(800, 600)):
+        """
+        Args:
+        parent (tk.Widget): Widget the viewer frame is created in, the caller packs viewer.frame.
+        size (tuple): Initial (width, height) of the view.
+        """
+        self.frame = tk.Frame(parent)
+        self.pyramid = None
+        self.regions = []
+        self.zoom = 1.0
+        self.origin = (0.0, 0.0)  # Image coordinates of the top left corner of the view
+        self._photo = None
+        self._image_item = None
+        self._redraw_pending = False
+        self._drag = None
+        # Refit when the view is resized, until the user zooms or pans
+        self._fitted = True
+
+        toolbar = tk.Frame(self.frame)
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        self.mask_var = tk.BooleanVar(value=False)
+        self.boxes_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(toolbar, text="Mask", variable=self.mask_var, command=self.schedule_redraw).pack(side=tk.LEFT)
+        tk.Checkbutton(toolbar, text="Boxes", variable=self.boxes_var, command=self.schedule_redraw).pack(side=tk.LEFT)
+        tk.Button(toolbar, text="Fit", command=self.fit).pack(side=tk.LEFT, padx=5)
+        tk.Button(toolbar, text="1:1", command=lambda: self.set_zoom(1.0)).pack(side=tk.LEFT)
+        self.zoom_label = tk.Label(toolbar, text="")
+        self.zoom_label.pack(side=tk.LEFT, padx=5)
+
+        self.canvas = tk.Canvas(self.frame, width=size[0], height=size[1], bg='gray25', highlightthickness=0)
+        self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.canvas.bind('<Configure>', lambda event: self.fit() if self._fitted else self.schedule_redraw())
+        self.canvas.bind('<ButtonPress-1>', self._start_drag)
+        self.canvas.bind('<B1-Motion>', self._drag_to)
+        self.canvas.bind('<Double-Button-1>', lambda event: self.fit())
+        # Windows and macOS send MouseWheel, X11 sends buttons 4 and 5
+        self.canvas.bind('<MouseWheel>', lambda event: self._wheel(event, event.delta > 0))
+        self.canvas.bind('<Button-4>', lambda event: self._wheel(event, True))
+        self.canvas.bind('<Button-5>', lambda event: self._wheel(event, False))
+
+    def show(self, pyramid, regions):
+        """
+        Display a new result, fitted to the view.
+
+        Args:
+        pyramid (ImagePyramid): The photo and its mask.
+        regions (list): Region dicts drawn on the box layer.
+        """
+        self.pyramid = pyramid
+        self.regions = regions
+        self.fit()
+
+    def view_size(self):
+        return max(self.canvas.winfo_width(), 1), max(self.canvas.winfo_height(), 1)
+
+    def fit_zoom(self):
+        width, height = self.pyramid.size
+        view_width, view_height = self.view_size()
+        return min(view_width / width, view_height / height)
+
+    def fit(self):
+        """Zoom out to show the whole image, centered."""
+        if self.pyramid is None:
+            return
+        self.zoom = self.fit_zoom()
+        self._center()
+        self._fitted = True
+        self.schedule_redraw()
+
+    def set_zoom(self, zoom, anchor=None):
+        """
+        Change the zoom, keeping the image point under anchor in place.
+
+        Args:
+        zoom (float): New zoom, limited to between half the fitted zoom and MAX_ZOOM.
+        anchor (tuple): View (x, y) that stays still, the center of the view by default.
+        """
+        if self.pyramid is None:
+            return
+        zoom = min(max(zoom, self.fit_zoom() / 2), MAX_ZOOM)
+        if anchor is None:
+            view_width, view_height = self.view_size()
+            anchor = (view_width / 2, view_height / 2)
+        x = self.origin[0] + anchor[0] / self.zoom
+        y = self.origin[1] + anchor[1] / self.zoom
+        self.zoom = zoom
+        self.origin = (x - anchor[0] / zoom, y - anchor[1] / zoom)
+        self._fitted = False
+        self.schedule_redraw()
+
+    def schedule_redraw(self):
+        # Coalesce the events of a drag or a fast wheel into one render when Tk is idle
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            self.canvas.after_idle(self.redraw)
+
+    def redraw(self):
+        from PIL import Image, ImageTk
+
+        self._redraw_pending = False
+        if self.pyramid is None:
+            return
+        size = self.view_size()
+        view = Image.fromarray(self.pyramid.render(self.origin, self.zoom, size, self.mask_var.get()))
+        if self._photo is not None and (self._photo.width(), self._photo.height()) == size:
+            self._photo.paste(view)  # Same size: update the Tk image in place
+        else:
+            self._photo = ImageTk.PhotoImage(view)
+            if self._image_item is None:
+                self._image_item = self.canvas.create_image(0, 0, anchor='nw', image=self._photo)
+            else:
+                self.canvas.itemconfig(self._image_item, image=self._photo)
+
+        self.canvas.delete('boxes')
+        if self.boxes_var.get():
+            self._draw_boxes(size)
+        self.zoom_label.config(text=f"{self.zoom:.0%}")
+
+    def _draw_boxes(self, size):
+        for region in self.regions:
+            x, y, w, h = region['box']
+            x0, y0 = (x - self.origin[0]) * self.zoom, (y - self.origin[1]) * self.zoom
+            x1, y1 = x0 + w * self.zoom, y0 + h * self.zoom
+            if x1 < 0 or y1 < 0 or x0 > size[0] or y0 > size[1]:
+                continue
+            self.canvas.create_rectangle(x0, y0, x1, y1, outline=BOX_COLOR, width=2, tags='boxes')
+            self.canvas.create_text(x0, y0 - 2, text=region['label'], anchor='sw', fill=BOX_COLOR,
+                                    font=('TkDefaultFont', 12, 'bold'), tags='boxes')
+
+    def _center(self):
+        width, height = self.pyramid.size
+        view_width, view_height = self.view_size()
+        self.origin = (width / 2 - view_width / 2 / self.zoom, height / 2 - view_height / 2 / self.zoom)
+
+    def _start_drag(self, event):
+        self._drag = (event.x, event.y, self.origin)
+
+    def _drag_to(self, event):
+        if self._drag is None or self.pyramid is None:
+            return
+        start_x, start_y, (origin_x, origin_y) = self._drag
+        self.origin = (origin_x - (event.x - start_x) / self.zoom, origin_y - (event.y - start_y) / self.zoom)
+        self._fitted = False
+        self.schedule_redraw()
+
+    def _wheel(self, event, zoom_in):
+        self.set_zoom(self.zoom * (ZOOM_STEP if zoom_in else 1 / ZOOM_STEP), (event.x, event.y))
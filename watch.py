@@ -0,0 +1,238 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from batch import IMAGE_EXTENSIONS, add_processing_arguments, calibrator_from_args, params_from_args, process_one
+from export import FIELDS, FORMATS, RecordWriter, region_records
+from utils import save_json
+
+# Columns of the watch results: the export records and when each image was processed
+WATCH_FIELDS = FIELDS + ('processed_at',)
+
+
+class Manifest:
+    """
+    Record of the images already processed, saved next to the results.
+
+    Each file name maps to the size and modification time it had when it was
+    processed, so a restart skips unchanged files and picks up changed ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as file:
+                self.entries = json.load(file)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def is_current(self, name, stat):
+        return self.entries.get(name) == [stat.st_size, stat.st_mtime_ns]
+
+    def add(self, name, stat):
+        self.entries[name] = [stat.st_size, stat.st_mtime_ns]
+
+    def save(self):
+        save_json(self.path, self.entries)
+
+
+class FolderWatcher:
+    """
+    Incrementally process the images dropped into a folder.
+
+    The folder is only listed when its modification time changes (files were
+    added, removed or renamed) and every rescan_interval seconds as a safety
+    net for files rewritten in place. Files that are new or changed are
+    tracked until their size and modification time stay the same for settle
+    seconds, so files still being written are never read. Settled files are
+    processed on a process pool and their records appended to the results
+    file (CSV or JSON Lines).
+    """
+
+    def __init__(self, directory, output_path, manifest_path, conversion_factor, label_preset, params, workers=None,
+                 cache_dir=None, settle=2.0, rescan_interval=300.0, calibrator=None):
+        self.directory = directory
+        self.output_path = output_path
+        self.manifest = Manifest(manifest_path)
+        self.conversion_factor = conversion_factor
+        self.label_preset = label_preset
+        self.params = params
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.settle = settle
+        self.rescan_interval = rescan_interval
+        # Marker calibration (see calibration.py), used instead of conversion_factor when set
+        self.calibrator = calibrator
+
+        self._directory_mtime = None
+        self._last_scan = 0.0
+        # name -> (size, mtime_ns, time the file was first seen with that size and mtime)
+        self._pending = {}
+        # future -> (name, stat) of the images being processed, and their names
+        self._in_flight = {}
+        self._busy = set()
+
+    def scan(self, now):
+        """List the folder if it changed (or a rescan is due) and track new or changed images."""
+        mtime = os.stat(self.directory).st_mtime_ns
+        # Coarse file system clocks (1 s on HFS+) can hide a second change within the same tick,
+        # so a folder modified in the last couple of seconds is listed again
+        recent = time.time() - mtime / 1e9 < 2
+        if mtime == self._directory_mtime and not recent and now - self._last_scan < self.rescan_interval:
+            return
+        self._directory_mtime = mtime
+        self._last_scan = now
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                name = entry.name
+                if not name.lower().endswith(IMAGE_EXTENSIONS) or name in self._pending or name in self._busy:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.is_file() and not self.manifest.is_current(name, stat):
+                    self._pending[name] = (stat.st_size, stat.st_mtime_ns, now)
+
+    def settled(self, now):
+        """Return the pending files whose size and modification time have stopped changing."""
+        ready = []
+        for name, (size, mtime, since) in list(self._pending.items()):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                del self._pending[name]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self._pending[name] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - since >= self.settle and stat.st_size > 0:
+                del self._pending[name]
+                ready.append((name, stat))
+        return ready
+
+    def run(self, poll_interval=1.0, once=False):
+        """
+        Watch the folder until interrupted.
+
+        Args:
+        poll_interval (float): Seconds between polls.
+        once (bool): Process what is in the folder and return instead of watching.
+        """
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            with RecordWriter(self.output_path, fields=WATCH_FIELDS, append=True) as writer:
+                try:
+                    while True:
+                        now = time.monotonic()
+                        self.scan(now)
+                        for name, stat in self.settled(now):
+                            path = os.path.join(self.directory, name)
+                            conversion_factor = (self.calibrator.rig_factors([path])[0] if self.calibrator
+                                                 else self.conversion_factor)
+                            future = executor.submit(process_one, path, conversion_factor, self.label_preset,
+                                                     self.params, None, self.cache_dir)
+                            self._in_flight[future] = (name, stat, conversion_factor)
+                            self._busy.add(name)
+
+                        if self._in_flight:
+                            done, _ = wait(self._in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                            broken = False
+                            for future in done:
+                                broken |= self._record(future, writer)
+                            if broken:
+                                # A worker died (out of memory, crash in native code) and took the pool down:
+                                # the other images in flight failed with it, then a new pool takes over
+                                for future in list(self._in_flight):
+                                    self._record(future, writer)
+                                executor.shutdown(wait=False)
+                                executor = ProcessPoolExecutor(max_workers=self.workers)
+                            self._commit(writer)
+                        elif once and not self._pending:
+                            break
+                        else:
+                            time.sleep(poll_interval)
+                except KeyboardInterrupt:
+                    print('Stopping, waiting for the images in progress...', file=sys.stderr)
+                    for future in list(self._in_flight):
+                        self._record(future, writer)
+                finally:
+                    self._commit(writer)
+        finally:
+            executor.shutdown()
+
+    def _commit(self, writer):
+        # The records reach the file before the manifest marks their images as done
+        writer.flush()
+        self.manifest.save()
+
+    def _record(self, future, writer):
+        """Write the records of a finished image and add it to the manifest, returns True if its worker died."""
+        name, stat, conversion_factor = self._in_flight.pop(future)
+        self._busy.discard(name)
+        broken = False
+        try:
+            _, records, error, _ = future.result()
+        except Exception as e:
+            broken = isinstance(e, BrokenProcessPool)
+            records, error = [], f'{type(e).__name__}: {str(e).strip()}'
+        processed_at = datetime.now().isoformat(timespec='seconds')
+        if error:
+            logging.error('%s failed: %s', name, error)
+            records = region_records(name, [], conversion_factor, self.params, error=error)
+        for record in records:
+            writer.write({**record, 'processed_at': processed_at})
+        # Failed files are recorded too, they are retried only once they change
+        self.manifest.add(name, stat)
+        measured = sum(1 for record in records if record.get('area_cm2') is not None)
+        print(f'{name}' + (' FAILED' if error else f': {measured} regions'), file=sys.stderr)
+        return broken
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Process new plate photos as they appear in a folder.')
+    parser.add_argument('directory', help='Folder to watch.')
+    parser.add_argument('-o', '--output', default='results.csv',
+                        help='File the results are appended to: .csv or .jsonl.')
+    parser.add_argument('--manifest', default=None,
+                        help='Processed-files manifest, defaults to the output file with a .manifest.json suffix.')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls.')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='Seconds a file must stay unchanged before it is considered fully written.')
+    parser.add_argument('--rescan-interval', type=float, default=300.0,
+                        help='Seconds between full listings of the folder when its modification time does not change.')
+    parser.add_argument('--once', action='store_true', help='Process the current backlog and exit.')
+    add_processing_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_format = FORMATS.get(os.path.splitext(args.output)[1].lower())
+    if output_format is None or output_format == 'parquet':
+        appendable = ', '.join(ext for ext, fmt in FORMATS.items() if fmt != 'parquet')
+        print(f"Unknown output format {args.output}, use one of {appendable}", file=sys.stderr)
+        return 1
+    manifest_path = args.manifest or os.path.splitext(args.output)[0] + '.manifest.json'
+
+    watcher = FolderWatcher(args.directory, args.output, manifest_path, args.conversion_factor, args.preset,
+                            params_from_args(args), args.workers, args.cache_dir, args.settle, args.rescan_interval,
+                            calibrator_from_args(args))
+    print(f'Watching {args.directory}, appending results to {args.output}', file=sys.stderr)
+    try:
+        watcher.run(args.interval, args.once)
+    except ValueError as e:
+        # Existing results file with other columns
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import queue
+import threading
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled or superseded."""
+
+
+class BackgroundProcessor:
+    """
+    Run one job at a time on a worker thread and hand its result back to Tk.
+
+    The job receives a progress(fraction, message) callback. Calling it
+    raises JobCancelled once the job has been cancelled, so long jobs stop
+    at their next checkpoint. Results travel through a queue polled with
+    root.after, so every callback runs on the Tk main loop. Submitting a new
+    job supersedes the one in flight: its remaining work is abandoned and
+    its result is dropped.
+    """
+
+    def __init__(self, root, poll_ms=50):
+        self.root = root
+        self.poll_ms = poll_ms
+        self._queue = queue.Queue()
+        self._job_id = 0
+        self._cancel_event = None
+        self._callbacks = None
+        self._polling = False
+
+    @property
+    def busy(self):
+        return self._cancel_event is not None
+
+    def submit(self, func, args=(), kwargs=None, on_done=None, on_error=None, on_progress=None):
+        """
+        Start func(*args, progress=..., **kwargs) on a worker thread.
+
+        Args:
+        func (callable): The job, must accept a progress keyword argument.
+        args (tuple): Positional arguments for the job.
+        kwargs (dict): Keyword arguments for the job.
+        on_done (callable): Called with the job's return value.
+        on_error (callable): Called with the exception raised by the job.
+        on_progress (callable): Called with (fraction, message) updates.
+        """
+        self.cancel()
+        self._job_id += 1
+        job_id = self._job_id
+        cancel_event = threading.Event()
+        self._cancel_event = cancel_event
+        self._callbacks = (on_done, on_error, on_progress)
+
+        def progress(fraction, message):
+            if cancel_event.is_set():
+                raise JobCancelled()
+            self._queue.put((job_id, 'progress', (fraction, message)))
+
+        def run():
+            try:
+                result = func(*args, progress=progress, **(kwargs or {}))
+            except JobCancelled:
+                return
+            except Exception as e:
+                self._queue.put((job_id, 'error', e))
+            else:
+                self._queue.put((job_id, 'done', result))
+
+        threading.Thread(target=run, daemon=True).start()
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.poll_ms, self._poll)
+
+    def cancel(self):
+        """Cancel the job in flight, if any. Its result will never be delivered."""
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+            self._cancel_event = None
+            self._callbacks = None
+
+    def _poll(self):
+        while True:
+            try:
+                job_id, kind, payload = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            # Messages from cancelled or superseded jobs are dropped
+            if job_id != self._job_id or self._callbacks is None:
+                continue
+
+            on_done, on_error, on_progress = self._callbacks
+            if kind == 'progress':
+                if on_progress:
+                    on_progress(*payload)
+                continue
+
+            self._cancel_event = None
+            self._callbacks = None
+            callback = on_done if kind == 'done' else on_error
+            if callback:
+                callback(payload)
+
+        if self.busy:
+            self.root.after(self.poll_ms, self._poll)
+        else:
+            self._polling = False
@@ -0,0 +1,72 @@
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Workspace:
+    """
+    Full-size arrays reused from one image to the next.
+
+    Each pipeline stage asks for its output array by name and OpenCV writes
+    into it through dst=, instead of allocating a new image-sized array per
+    stage and per image. A buffer only grows: a smaller image (or a tiled
+    strip) gets a view into the existing one, so a batch of same-size photos
+    allocates its arrays once. An array handed out stays valid until the
+    same name is asked for again, so nothing taken from a workspace may be
+    kept past the image it was computed for.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def array(self, name, shape, dtype=np.uint8, report=None):
+        """
+        Return an uninitialized array backed by the named buffer.
+
+        Args:
+        name (str): Buffer name, one per pipeline output.
+        shape (tuple): Shape of the array.
+        dtype (numpy.dtype): Type of the array.
+        report (StageReport): Optional profiling report, new allocations are recorded in it.
+
+        Returns:
+        numpy.ndarray: A C-contiguous array of that shape and type.
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.nbytes < size:
+            buffer = self._buffers[name] = np.empty(size, dtype=np.uint8)
+            allocated = True
+        else:
+            allocated = False
+        array = buffer[:size].view(dtype).reshape(shape)
+        if allocated and report is not None:
+            report.record(name, array)
+        return array
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def clear(self):
+        """Free every buffer."""
+        self._buffers.clear()
+
+    @contextmanager
+    def borrow(self):
+        """
+        Use this workspace for one image, or a temporary one if another job is using it.
+
+        A superseded GUI job may still be running when the next one starts,
+        they must not write into the same buffers.
+        """
+        if not self._lock.acquire(blocking=False):
+            yield Workspace()
+            return
+        try:
+            yield self
+        finally:
+            self._lock.release()